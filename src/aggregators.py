@@ -2,10 +2,37 @@
 
 #region Imports
 import numpy as np
+import pandas as pd
+
+from segments import SegmentIndex
 #endregion 
 
 #region Series Aggregation
+def segment_index(df):
+    """Segment index of the rows of `df` per 'seqid', sorted by 'timeindex_bin' within a sequence. Can be reused
+    for every aggregation of the same rows, through the `segments` argument of the aggregation methods."""
+    return SegmentIndex(df['seqid'].to_numpy(), df['timeindex_bin'].to_numpy())
+
+def aggregate_sums(df, columns, transform, normalize=True, segments=None):
+    """
+    Per sequence sums of `transform` of the scores of all `columns` at once, optionally divided by the number of
+    bins of the sequence. NaN scores count as 0, as in the pandas sums of `aggregate_scores`.
+
+    :param transform: function of the (rows x columns) score array to the array to sum, element-wise
+    :param segments: SegmentIndex of the rows, see `segment_index`
+    """
+    segments = segment_index(df) if segments is None else segments
+
+    values = transform(df[columns].to_numpy(dtype=np.float64))
+    if values.dtype.kind == 'f':
+        values = np.where(np.isnan(values), 0.0, values)
+    sums = segments.sum(values)
 
+    if normalize:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sums = sums / segments.sum(df['timeindex_bin'].notna().to_numpy(dtype=np.int64))[:, None]
+
+    return pd.DataFrame({'seqid' : segments.labels} | {col : sums[:, i] for i, col in enumerate(columns)})
 #endregion
 
 #region Aggregation Methods
@@ -22,22 +49,211 @@ def aggregate_scores(df, columns, funcs, normalize=True):
     return agg_df
 
 # Aggregation Methods
-def aggr_sum(df, columns, normalize=True):
-    return aggregate_scores(df, columns, [lambda x : np.sum(abs(x))]*len(columns), normalize)
+def aggr_sum(df, columns, normalize=True, segments=None):
+    return aggregate_sums(df, columns, np.abs, normalize, segments)
+
+def aggr_sqrtsum(df, columns, normalize=True, segments=None):
+    return aggregate_sums(df, columns, np.square, normalize, segments)
+
+# Aggregation Methods using Threshold, thresholds[i] is the threshold of columns[i]
+def aggr_count_threshold_crossings(df, columns, thresholds, normalize=True, segments=None):
+    return aggregate_sums(df, columns, lambda x : x >= np.asarray(thresholds), normalize, segments)
+
+def aggr_sum_threshold_crossings(df, columns, thresholds, normalize=True, segments=None):
+    return aggregate_sums(df, columns, lambda x : np.where(x >= np.asarray(thresholds), x, 0.0), normalize, segments)
+
+def aggr_sqrtsum_threshold_crossings(df, columns, thresholds, normalize=True, segments=None):
+    return aggregate_sums(df, columns, lambda x : np.where(x >= np.asarray(thresholds), x**2, 0.0), normalize, segments)
+
+def aggr_threshold_sweep(df, column, thresholds, normalize=True, segments=None):
+    """
+    Count and sum of the threshold crossings (scores >= threshold) of `column` per sequence, for every threshold
+    at once, as `aggr_count_threshold_crossings` and `aggr_sum_threshold_crossings` per threshold.
+
+    The rows are sorted once by sequence and score, under an integer key of the sequence code and the rank of the
+    score, such that the first crossing of every (sequence, threshold) is one `searchsorted` of that key. The counts
+    and sums then follow from the sequence ends and the cumulative sums of the sorted scores. NaN scores never cross.
+
+    :param thresholds: array-like of float
+    :return: the seqids, the counts and the sums (both sequences x thresholds)
+    """
+    segments = segment_index(df) if segments is None else segments
+    values = df[column].to_numpy(dtype=np.float64)
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    # Rank 0 for NaN, the scores in ascending order from 1, and a threshold's rank is 1 + the scores below it
+    valid = ~np.isnan(values)
+    ranked = np.sort(values[valid])
+    ranks = np.zeros(len(values), dtype=np.int64)
+    ranks[np.flatnonzero(valid)[np.argsort(values[valid], kind='stable')]] = np.arange(1, len(ranked) + 1)
+
+    width = len(ranked) + 2
+    keys = segments.codes.astype(np.int64) * width + ranks
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    cumulative = np.r_[0.0, np.cumsum(np.where(valid, values, 0.0)[order])]
+
+    queries = np.arange(len(segments), dtype=np.int64)[:, None] * width + 1 + np.searchsorted(ranked, thresholds)[None, :]
+    firsts = np.searchsorted(keys, queries)
+    ends = segments.ends[:, None]
+
+    counts = ends - firsts
+    sums = cumulative[ends] - cumulative[firsts]
+
+    if normalize:
+        bins = segments.sum(df['timeindex_bin'].notna().to_numpy(dtype=np.int64))[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            counts, sums = counts / bins, sums / bins
+
+    return segments.labels, counts, sums
+#endregion
+
+#region Windowed Aggregation Methods
+# Aggregations of localized anomalies, of the absolute scores (NaN as 0) in the order of the bins of a sequence.
+# Use functools.partial to set the window or k of an `aggrfunc`, e.g. partial(aggr_max_rolling_mean, window=10).
+def aggr_max_rolling_sum(df, columns, window=10, segments=None):
+    """Per sequence maximum of the sums of `window` consecutive bins, the whole sequence if it is shorter."""
+    segments = segment_index(df) if segments is None else segments
+    sums, _ = _rolling_sums(df, columns, window, segments)
+
+    return _frame(segments, columns, sums)
+
+def aggr_max_rolling_mean(df, columns, window=10, segments=None):
+    """Per sequence maximum of the means of `window` consecutive bins, the whole sequence if it is shorter."""
+    segments = segment_index(df) if segments is None else segments
+    sums, lengths = _rolling_sums(df, columns, window, segments)
+
+    return _frame(segments, columns, sums / lengths[:, None])
 
-def aggr_sqrtsum(df, columns, normalize=True):
-    return aggregate_scores(df, columns, [lambda x : np.sum(x**2)]*len(columns), normalize)
+def aggr_topk_mean(df, columns, k=10, segments=None):
+    """Per sequence mean of the `k` largest scores, of all scores if the sequence has fewer."""
+    segments = segment_index(df) if segments is None else segments
+    values = segments.sort_within(_absolute(df, columns))
+    cumulative = np.vstack((np.zeros((1, len(columns))), np.cumsum(values, axis=0)))
 
-# Aggregation Methods using Threshold
-def aggr_count_threshold_crossings(df, columns, thresholds, normalize=True):
-    funcs = [lambda x : np.sum(x >= t) for t in thresholds]
-    return aggregate_scores(df, columns, funcs, normalize)
+    k = np.minimum(k, segments.counts)
+    means = (cumulative[segments.ends] - cumulative[segments.ends - k]) / k[:, None]
 
-def aggr_sum_threshold_crossings(df, columns, thresholds, normalize=True):
-    funcs = [lambda x : np.sum( [v if v >= t else 0 for v in x] ) for t in thresholds]
-    return aggregate_scores(df, columns, funcs, normalize)
+    return _frame(segments, columns, means)
 
-def aggr_sqrtsum_threshold_crossings(df, columns, thresholds, normalize=True):
-    funcs = [lambda x : np.sum(([v**2 if v >= t else 0 for v in x])) for t in thresholds]
-    return aggregate_scores(df, columns, funcs, normalize)
-#endregion
\ No newline at end of file
+def _absolute(df, columns):
+    values = np.abs(df[columns].to_numpy(dtype=np.float64))
+    return np.where(np.isnan(values), 0.0, values)
+
+def _rolling_sums(df, columns, window, segments):
+    """Per sequence maximum window sum of every column, and the window length per sequence."""
+    values = segments.sort(_absolute(df, columns))
+    cumulative = np.vstack((np.zeros((1, len(columns))), np.cumsum(values, axis=0)))
+
+    # Every row ends a window, only the windows of the full length (min(window, count)) are candidates
+    lengths = np.minimum(window, segments.counts)
+    ends = np.arange(1, len(values) + 1)
+    starts = ends - np.repeat(lengths, segments.counts)
+    full = starts >= np.repeat(segments.starts, segments.counts)
+
+    sums = np.where(full[:, None], cumulative[ends] - cumulative[np.maximum(starts, 0)], -np.inf)
+    return segments.reduce(sums, np.maximum, presorted=True), lengths
+
+def _frame(segments, columns, values):
+    return pd.DataFrame({'seqid' : segments.labels} | {col : values[:, i] for i, col in enumerate(columns)})
+#endregion
+
+#region Streaming Aggregation
+class StreamingAggregator:
+    """
+    Running per sequence aggregates of score batches, for scores that arrive incrementally (per model or group of
+    `Experiment.run`, per partition of `Experiment.run_partitioned` or from a live scorer), such that the per bin
+    scores never have to be kept. Per sequence and column it keeps the sum of the absolute scores, the sum of the
+    squared scores, the number of bins and the number of threshold crossings, in arrays that grow by doubling.
+
+    The aggregates can be read at any time with `frame`, equal to those of `aggr_sum`, `aggr_sqrtsum` and
+    `aggr_count_threshold_crossings` over all scores seen so far. NaN scores count as 0 (and never cross).
+
+    :param columns: list of str, the score columns
+    :param thresholds: array-like, threshold per column for the crossings (default no crossings)
+    :param statistic: str, default statistic of `frame`
+    :param normalize: bool, default normalization of `frame`
+    :param capacity: int, initial number of sequences
+    """
+    def __init__(self, columns, thresholds=None, statistic='sum', normalize=True, capacity=1024):
+        self.columns = list(columns)
+        self.statistic = statistic
+        self.normalize = normalize
+        self.thresholds = np.full(len(self.columns), np.inf) if thresholds is None else np.asarray(thresholds, dtype=np.float64)
+        self.slots = {}
+        self.seqids = []
+
+        shape = (capacity, len(self.columns))
+        self.sums, self.squares = np.zeros(shape), np.zeros(shape)
+        self.counts, self.crossings = np.zeros(shape, dtype=np.int64), np.zeros(shape, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.seqids)
+
+    def update(self, seqid, scores, columns=None, timeindex_bin=None):
+        """
+        Add a batch of per bin scores.
+
+        :param seqid: array-like, sequence id per row
+        :param scores: array-like (rows x columns), scores per row
+        :param columns: list of str, the columns of `scores`, a subset of the columns (default all)
+        :param timeindex_bin: array-like, bin per row, rows without a bin are not counted (as in `aggregate_sums`)
+        """
+        indices = [self.columns.index(col) for col in (self.columns if columns is None else columns)]
+        scores = np.asarray(scores, dtype=np.float64).reshape(len(seqid), len(indices))
+
+        codes, uniques = pd.factorize(np.asarray(seqid))
+        slots = self._slots(uniques)
+
+        def add(array, values):
+            array[np.ix_(slots, indices)] += np.column_stack([
+                np.bincount(codes, weights=values[:, i], minlength=len(uniques)) for i in range(len(indices))
+            ]).astype(array.dtype, copy=False)
+
+        binned = np.ones(len(codes)) if timeindex_bin is None else pd.notna(np.asarray(timeindex_bin)).astype(np.float64)
+        add(self.counts, np.repeat(binned[:, None], len(indices), axis=1))
+
+        absolute = np.where(np.isnan(scores), 0.0, np.abs(scores))
+        add(self.sums, absolute)
+        add(self.squares, absolute**2)
+        add(self.crossings, (scores >= self.thresholds[indices]).astype(np.float64))
+
+    def update_frame(self, df, columns=None):
+        """Add the scores of the rows of `df`, with the columns 'seqid', 'timeindex_bin' and the score columns."""
+        columns = [col for col in self.columns if col in df] if columns is None else columns
+        self.update(df['seqid'].to_numpy(), df[columns].to_numpy(dtype=np.float64), columns, df['timeindex_bin'].to_numpy())
+
+    def frame(self, statistic=None, normalize=None):
+        """
+        The current aggregates of `statistic` ('sum', 'sqrtsum' or 'crossings') per sequence, sorted on seqid, as
+        the aggregation methods return them.
+        """
+        statistic = self.statistic if statistic is None else statistic
+        normalize = self.normalize if normalize is None else normalize
+        n = len(self)
+        values = {'sum' : self.sums, 'sqrtsum' : self.squares, 'crossings' : self.crossings}[statistic][:n]
+
+        if normalize:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = values / self.counts[:n]
+
+        order = np.argsort(np.asarray(self.seqids, dtype=object), kind='stable')
+        return pd.DataFrame({'seqid' : np.asarray(self.seqids, dtype=object)[order]} | {col : values[order, i] for i, col in enumerate(self.columns)})
+
+    def _slots(self, seqids):
+        """Slot of every sequence id, new sequences get the next slots, growing the arrays when full."""
+        for seqid in seqids:
+            if seqid not in self.slots:
+                self.slots[seqid] = len(self.seqids)
+                self.seqids += [seqid]
+
+        if len(self.seqids) > len(self.sums):
+            capacity = max(len(self.seqids), 2 * len(self.sums))
+            for name in ('sums', 'squares', 'counts', 'crossings'):
+                array = getattr(self, name)
+                grown = np.zeros((capacity, array.shape[1]), dtype=array.dtype)
+                grown[:len(array)] = array
+                setattr(self, name, grown)
+
+        return np.fromiter((self.slots[seqid] for seqid in seqids), dtype=np.int64, count=len(seqids))
+#endregion
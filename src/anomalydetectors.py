@@ -1,206 +1,1003 @@
+import os
+import json
+import inspect
+import warnings
 import pandas as pd
 import numpy as np
+import sklearn
+import concurrent.futures
 
 from abc import ABC, abstractmethod
+from contextlib import nullcontext
 from functools import reduce
-from scipy.stats import median_abs_deviation
-from scipy.spatial.distance import mahalanobis
-from sklearn.neighbors import LocalOutlierFactor
+from itertools import repeat
+from sklearn.neighbors import LocalOutlierFactor, NearestNeighbors
 from sklearn.ensemble import IsolationForest
 from sklearn.covariance import MinCovDet
 
+from segments import SegmentIndex, complete_rows
+
+try:
+    from hmmlearn.hmm import GMMHMM
+except ImportError:
+    GMMHMM = None
+
+#
+# DetectorInput
+#
+def _readonly(array):
+    array = np.asarray(array)
+    array.flags.writeable = False
+    return array
+
+class DetectorInput:
+    """
+    Read-only columnar input of the detectors: one contiguous feature array plus the key arrays of the rows.
+
+    Detectors only read from these arrays and return score arrays, so a single DetectorInput (and its slices)
+    can be shared by all models and threads of an experiment without copies. The derived arrays of `with_time`
+    are built once per DetectorInput and shared too.
+
+    :param seqid: array, integer code per row into `seqids`
+    :param seqids: array, the sequence ids
+    :param timeindex_bin: array, bin per row
+    :param timeindex: array, time per row
+    :param features: array, rows x feature columns (float32 or float64)
+    :param columns: list[str], names of the feature columns
+    """
+    def __init__(self, seqid, seqids, timeindex_bin, timeindex, features, columns):
+        self.seqid = _readonly(seqid)
+        self.seqids = _readonly(seqids)
+        self.timeindex_bin = _readonly(timeindex_bin)
+        self.timeindex = _readonly(timeindex)
+        self.features = _readonly(np.ascontiguousarray(features))
+        self.columns = list(columns)
+        self.derived = {}
+
+    def __len__(self):
+        return len(self.features)
+
+    @classmethod
+    def from_frame(cls, df, columns, rows=None, dtype=np.float64):
+        """Input from the columns of a DataFrame, optionally only the positional `rows` (in that order)."""
+        take = (lambda a : a) if rows is None else (lambda a : a[rows])
+        seqid, seqids = pd.factorize(df['seqid'])
+        timeindex = df['timeindex'].to_numpy(dtype=np.float64) if 'timeindex' in df else np.full(len(df), np.nan)
+
+        return cls(take(seqid), np.asarray(seqids), take(df['timeindex_bin'].to_numpy()), take(timeindex),
+                   take(df[columns[1]].to_numpy(dtype=dtype)), columns[1])
+
+    @classmethod
+    def of(cls, data, columns):
+        return data if isinstance(data, cls) else cls.from_frame(data, columns)
+
+    def slice(self, start, stop):
+        """View on the rows `start:stop`."""
+        return DetectorInput(self.seqid[start:stop], self.seqids, self.timeindex_bin[start:stop],
+                             self.timeindex[start:stop], self.features[start:stop], self.columns)
+
+    def select(self, columns):
+        """Feature array of `columns`, without a copy when these are all the feature columns in order."""
+        if list(columns) == self.columns:
+            return self.features
+        return self.features[:, [self.columns.index(col) for col in columns]]
+
+    def with_time(self, columns):
+        """Read-only float64 array of 'timeindex' followed by the feature `columns`, the input of LOF and IF."""
+        key = ('with_time', tuple(columns))
+        if key not in self.derived:
+            # Models in other threads may build it at the same time, all of them use the first one stored
+            array = np.column_stack((self.timeindex, self.select(columns))).astype(np.float64, copy=False)
+            self.derived.setdefault(key, _readonly(array))
+        return self.derived[key]
+
 #
 # AnomalyDetector
 #
+def _cores(n_jobs, default=-1):
+    """Number of cores of an n_jobs parameter, with None meaning `default` and -1 all cores."""
+    n_jobs = default if n_jobs is None else n_jobs
+    return os.cpu_count() if n_jobs == -1 else n_jobs
+
 class AnomalyDetector(ABC):
-    def __init__(self, column_name):
+    # Whether the detector implements `partial_fit`
+    incremental = False
+
+    def __init__(self, column_name, refit=True):
         self.model = None
         self.name = self.column_name = column_name
+        self.column_names = [column_name]
+        self.refit = refit
 
+    # The methods take a DetectorInput or a DataFrame (converted with DetectorInput.of), and return a score array
+    # with one row per input row, and one column per result column for detectors with several column_names.
     @abstractmethod
-    def fit(self, df, columns, verbose=False):
+    def fit(self, data, columns, verbose=False):
         pass
 
     @abstractmethod
-    def score(self, df, columns):
+    def score(self, data, columns):
         pass
 
-    def fit_score(self, df, columns, verbose=False):
-        if verbose:
-            print(f"Start fitting {self.column_name}")
-            
-        self.fit(df, columns, verbose)
-
-        if verbose:
-            print(f"Fitting {self.column_name} done")
+    def partial_fit(self, data, columns):
+        """
+        Update the model with the rows of `data`, fitting it if there is no model yet. Only the detectors with
+        `incremental` set implement it (ZScore, MZScore and MahalanobisDistance), the others raise
+        NotImplementedError and are refitted with `fit` instead.
+        """
+        raise NotImplementedError(f"{type(self).__name__} does not support incremental fitting, use fit instead.")
+
+    def score_batch(self, data, columns):
+        """Scores of a batch of (new) rows against the current model, without updating it."""
+        return self.score(data, columns)
+
+    def score_one(self, row, columns):
+        """Score of a single row, given as a mapping with 'timeindex_bin', 'timeindex' and the feature columns."""
+        data = DetectorInput(np.zeros(1, dtype=np.int64), np.array(['']), np.array([row['timeindex_bin']]),
+                             np.array([row.get('timeindex', np.nan)], dtype=np.float64),
+                             np.array([[row[col] for col in columns[1]]], dtype=np.float64), columns[1])
+        return self.score_batch(data, columns)[0]
+
+    def score_fitted(self, data, columns):
+        """Scores of the input the model was just fitted on, for detectors where these differ from `score`."""
+        return self.score(data, columns)
+
+    def params(self):
+        """
+        Hyperparameters of the detector: its constructor arguments that it keeps as attributes, except n_jobs,
+        which does not change the scores. A fitted model that `fit_score` would reuse is part of them.
+        """
+        names = inspect.signature(type(self).__init__).parameters
+        params = {name : getattr(self, name) for name in names if name not in ('self', 'n_jobs') and hasattr(self, name)}
+        params['column_names'] = self.column_names
+
+        if not (self.refit or self.model is None):
+            params['model'] = self.model
+        return params
+
+    def parallelism(self, stage=None):
+        """Number of cores the detector uses in `stage` ('fit' or 'score'), or the most of either stage if None."""
+        return 1
+
+    def set_parallelism(self, cores):
+        """Limit the detector to `cores` cores (None restores its own n_jobs), for detectors with an n_jobs parameter."""
+        if not hasattr(self, 'n_jobs'):
+            return
+
+        if cores is None:
+            self.n_jobs = self.__dict__.pop('_n_jobs', self.n_jobs)
+        else:
+            self.__dict__.setdefault('_n_jobs', self.n_jobs)
+            self.n_jobs = cores
+
+    def fit_score(self, data, columns, verbose=False, step=None):
+        """
+        Fit on and score `data`, without modifying it. A fitted model with refit disabled only scores. With `step`,
+        a function of the stage name ('fit' or 'score') that returns a context manager, the stages run in it.
+        """
+        data = DetectorInput.of(data, columns)
+        step = step or (lambda stage : nullcontext())
+
+        if self.refit or self.model is None:
+            if verbose:
+                print(f"Start fitting {self.column_name}")
+
+            with step('fit'):
+                self.fit(data, columns, verbose)
+
+            if verbose:
+                print(f"Fitting {self.column_name} done")
+
+            with step('score'):
+                return self.score_fitted(data, columns)
+
+        with step('score'):
+            return self.score(data, columns)
 
-        df[self.column_name] = self.score(df, columns)
-
-        return df[['seqid', 'timeindex_bin', self.column_name]]
+#
+# BinProfile
+#
+class BinProfile:
+    """
+    Reference profile of per-'timeindex_bin' statistics (e.g. location and scale arrays) of a fitted detector.
+
+    :param bins: array, sorted unique 'timeindex_bin' values
+    :param columns: list[str], feature columns the statistics were computed on
+    :param arrays: arrays with one row per bin
+    """
+    def __init__(self, bins, columns, **arrays):
+        self.bins = np.asarray(bins)
+        self.columns = list(columns)
+        self.arrays = arrays
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def lookup(self, bins):
+        """Row index into the profile for every bin in `bins`, -1 for bins that are not in the profile."""
+        bins = np.asarray(bins)
+        if len(self.bins) == 0:
+            return np.full(len(bins), -1)
+
+        idx = np.searchsorted(self.bins, bins)
+        idx[idx == len(self.bins)] = 0
+        idx[self.bins[idx] != bins] = -1
+        return idx
+
+    def take(self, bins, *names):
+        """Per-row statistics `names` for the rows with bins `bins`, NaN for bins that are not in the profile."""
+        return self.gather(self.lookup(bins), *names)
+
+    def gather(self, idx, *names):
+        """Per-row statistics `names` for the profile rows `idx` of `lookup`, NaN for -1."""
+        known = idx >= 0
+
+        result = []
+        for name in names:
+            values = np.full((len(idx),) + self.arrays[name].shape[1:], np.nan)
+            values[known] = self.arrays[name][idx[known]]
+            result += [values]
+        return result
+
+    def save(self, path):
+        np.savez(path, bins=self.bins, columns=np.array(self.columns), **self.arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            arrays = {key : data[key] for key in data.files if key not in ('bins', 'columns')}
+            return cls(data['bins'], data['columns'].tolist(), **arrays)
+
+def _expand(array, ndim):
+    """`array` with trailing axes added up to `ndim` axes, to broadcast per-bin values over per-bin arrays."""
+    return array.reshape(array.shape + (1,) * (ndim - array.ndim))
+
+def _update_moments(profile, segments, X, comoment=False):
+    """
+    Per-bin count, mean and sum of squared deviations (or co-moment matrices) of the profile merged with the rows `X`.
+
+    The rows are reduced per bin first, and merged into the running moments of the profile with the pairwise
+    (Chan et al.) form of Welford's update. Without a profile, these are the moments of `X`. NaN values are left
+    out: the counts are per bin and column, with co-moments they are per bin and count the rows without NaN.
+    """
+    bins = segments.labels if profile is None else np.union1d(profile.bins, segments.labels)
+    key = 'comoment' if comoment else 'm2'
+    _require(profile, 'count', 'location', key)
+    X = complete_rows(X) if comoment else np.asarray(X, dtype=np.float64)
+
+    n_b = segments.count(X)[:, 0] if comoment else segments.count(X)
+    mean_b = segments.mean(X)
+    m2_b = segments.comoment(X) if comoment else segments.m2(X)
+
+    if profile is None:
+        return {'bins' : bins, 'count' : n_b.astype(np.float64), 'location' : mean_b, key : m2_b}
+
+    # Bins (or columns) without rows on either side contribute zero moments
+    batch = BinProfile(segments.labels, [], count=n_b, location=mean_b, **{key : m2_b})
+    n_b, mean_b, m2_b = (np.nan_to_num(a) for a in batch.take(bins, 'count', 'location', key))
+    n_a, mean_a, m2_a = (np.nan_to_num(a) for a in profile.take(bins, 'count', 'location', key))
+    n_a = _expand(n_a, n_b.ndim)
+
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = mean_a + delta * _expand(n_b / n, 2)
+        weight = n_a * n_b / n
+    m2 = m2_a + m2_b + (np.einsum('ni,nj->nij', delta, delta) if comoment else delta**2) * _expand(weight, m2_b.ndim)
+
+    return {'bins' : bins, 'count' : n.astype(np.float64), 'location' : mean, key : m2}
+
+def _require(profile, *names):
+    """Raise a ValueError if `profile` lacks any of the arrays `names` that an update needs."""
+    missing = [name for name in names if profile is not None and name not in profile.arrays]
+    if missing:
+        raise ValueError(f"The profile has no {', '.join(missing)}, it can be scored against but not updated with partial_fit.")
+
+def _update_reservoir(profile, segments, X, bins, size, rng):
+    """
+    Per-bin uniform samples of at most `size` rows of the profile merged with the rows `X`, by reservoir sampling
+    (Algorithm R), as a bins x size x features array with NaN for the empty slots, and the number of rows seen per
+    bin. While a bin has seen at most `size` rows, its sample holds all of them. The size of a profile's samples
+    takes precedence over `size`.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    _require(profile, 'reservoir', 'seen')
+
+    if profile is None:
+        reservoir, seen = np.full((len(bins), size, X.shape[1]), np.nan), np.zeros(len(bins), dtype=np.int64)
+    else:
+        reservoir, seen = profile.take(bins, 'reservoir', 'seen')
+        seen, size = np.nan_to_num(seen).astype(np.int64), reservoir.shape[1]
+
+    # Every row is the t-th of its bin, it takes slot t of a filling sample, else a random slot with probability
+    # size / (t + 1). Within a bin the rows are in order, so of two rows drawing the same slot the later one wins.
+    rows = segments.sort(X)
+    positions = np.searchsorted(bins, segments.labels)
+    pos = np.repeat(positions, segments.counts)
+    t = seen[pos] + np.arange(len(rows)) - np.repeat(segments.starts, segments.counts)
+    slot = np.where(t < size, t, np.floor(rng.random(len(rows)) * (t + 1)).astype(np.int64))
+
+    keep = slot < size
+    reservoir[pos[keep], slot[keep]] = rows[keep]
+    seen[positions] += segments.counts
+
+    return reservoir, seen
+
+def _reservoir_mad(reservoir):
+    """Per-bin median absolute deviation of the samples of `_update_reservoir`, NaN for bins without values."""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        median = np.nanmedian(reservoir, axis=1)
+        return np.nanmedian(np.abs(reservoir - median[:, None]), axis=1)
+
+def _mean_columns(x):
+    """Default aggregation of per-feature scores into one score per row, NaN scores count as 0."""
+    return np.nansum(x, axis=1) / x.shape[1]
+
+def _unknown_nan(scores, idx):
+    """Scores with the rows of bins that are not in the profile (`idx` -1) set to NaN."""
+    scores = np.asarray(scores, dtype=np.float64)
+    return np.where(_expand(idx < 0, scores.ndim), np.nan, scores)
 
 #
 # ZScore
 #
 class ZScore(AnomalyDetector):
-    def __init__(self, n_neighbors=20, aggr=None):
-        super().__init__(column_name="z")
+    incremental = True
+
+    def __init__(self, n_neighbors=20, aggr=None, profile=None, refit=True):
+        super().__init__(column_name="z", refit=refit)
         self.columns = None
-        self.aggr = None
+        self.aggr = aggr
+        self.model = profile
 
-    def fit(self, df, columns, verbose):
-        self.model = df[columns[0]].copy()
+    def fit(self, data, columns, verbose):
+        self.model = None
+        return self.partial_fit(data, columns)
+
+    def partial_fit(self, data, columns):
+        data = DetectorInput.of(data, columns)
         self.columns = columns
-        col_time = 'timeindex_bin'
+        X = data.select(columns[1])
 
-        for col in columns[1]:
-            mean_std_cols = df.groupby(col_time)[col].agg(**{f'{col}_mean' : 'mean', f'{col}_std' : 'std'}).reset_index()
+        # Sort once on the bins, and update the running moments of all feature columns together
+        moments = _update_moments(self.model, SegmentIndex(data.timeindex_bin), X)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scale = np.sqrt(moments['m2'] / (moments['count'] - 1))
 
-            self.model = pd.merge(self.model, mean_std_cols, on=col_time, how='left')
-            self.model[f'{col}_zscore'] = np.abs((df[col] - self.model[f'{col}_mean']) / self.model[f'{col}_std'])
+        self.model = BinProfile(moments.pop('bins'), columns[1], scale=scale, **moments)
 
         return self
 
-    def score(self, df, columns):
+    def score(self, data, columns):
         if self.model is None:
             raise ValueError("Model has not been fitted yet.")
         
-        if self.aggr == None:
-            self.aggr = lambda x : np.sum(x, axis=1) / len(columns[1])
-        
-        zscore = self.aggr(self.model[[f'{col}_zscore' for col in columns[1]]])
+        aggr = _mean_columns if self.aggr is None else self.aggr
+
+        data = DetectorInput.of(data, columns)
+        X = data.select(self.model.columns)
+        idx = self.model.lookup(data.timeindex_bin)
+        location, scale = self.model.gather(idx, 'location', 'scale')
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            zscore = aggr(np.abs((X - location) / scale))
         
-        return zscore
+        return _unknown_nan(zscore, idx)
     
 #
 # MZScore
 # 
 class MZScore(AnomalyDetector):
-    def __init__(self, n_neighbors=20, aggr=None):
-        super().__init__(column_name="mz")
+    """
+    Modified z-score per 'timeindex_bin': the deviation from the bin mean scaled by the bin MAD.
+
+    The MAD has no running update. `fit` takes the exact MAD of the rows, `partial_fit` that of a uniform sample of
+    at most `reservoir` rows per bin, kept up to date by reservoir sampling, which is exact while a bin has at most
+    that many rows. The mean skips NaN, but a NaN in a bin makes the MAD of its column NaN (as
+    `scipy.stats.median_abs_deviation`), such that the column scores 0 in that bin.
+
+    :param reservoir: int, number of rows per bin sampled for the MAD of `partial_fit`
+    :param random_state: int, seed of the sampling
+    """
+    incremental = True
+
+    def __init__(self, n_neighbors=20, aggr=None, profile=None, reservoir=256, random_state=42, refit=True):
+        super().__init__(column_name="mz", refit=refit)
         self.columns = None
-        self.aggr = None
+        self.aggr = aggr
+        self.model = profile
+        self.reservoir = reservoir
+        self.random_state = random_state
+        self.rng = None
+
+    def fit(self, data, columns, verbose):
+        self.model, self.rng = None, None
+        return self._update(data, columns, exact=True)
+
+    def partial_fit(self, data, columns):
+        return self._update(data, columns)
 
-    def fit(self, df, columns, verbose):
-        self.model = df[columns[0]].copy()
+    def _update(self, data, columns, exact=False):
+        data = DetectorInput.of(data, columns)
         self.columns = columns
-        col_time = 'timeindex_bin'
+        X = data.select(columns[1])
 
-        for col in columns[1]:
-            mean_std_cols = df.groupby(col_time)[col].agg(**{f'{col}_mean' : 'mean', f'{col}_mad' : median_abs_deviation}).reset_index()
+        # Sort once on the bins, and update the running moments and the samples of all feature columns together
+        segments = SegmentIndex(data.timeindex_bin)
+        moments = _update_moments(self.model, segments, X)
+        self.rng = self.rng or np.random.default_rng(self.random_state)
+        reservoir, seen = _update_reservoir(self.model, segments, X, moments['bins'], self.reservoir, self.rng)
+
+        # Without a profile the bins are those of the segments. As scipy's median_abs_deviation, a bin that has seen
+        # a NaN in a column has MAD NaN there, and its rows score 0 on that column.
+        scale = segments.mad(X) if exact else _reservoir_mad(reservoir)
+        scale[moments['count'] < seen[:, None]] = np.nan
+        self.model = BinProfile(moments.pop('bins'), columns[1], scale=scale, reservoir=reservoir, seen=seen, **moments)
 
-            self.model = pd.merge(self.model, mean_std_cols, on=col_time, how='left')
-            self.model[f'{col}_mzscore'] = np.abs((0.6745*(df[col] - self.model[f'{col}_mean'])) / self.model[f'{col}_mad'])
-            self.model[f'{col}_mzscore'] = np.where(np.isinf(self.model[f'{col}_mzscore']) | (np.abs(self.model[f'{col}_mzscore']) > np.finfo(np.float64).max), 
-                                                    1, 
-                                                    self.model[f'{col}_mzscore'])
         return self
 
-    def score(self, df, columns):
+    def score(self, data, columns):
         if self.model is None:
             raise ValueError("Model has not been fitted yet.")
         
-        if self.aggr == None:
-            self.aggr = lambda x : np.sum(x, axis=1) / len(columns[1])
-        
-        zscore = self.aggr(self.model[[f'{col}_mzscore' for col in columns[1]]])
+        aggr = _mean_columns if self.aggr is None else self.aggr
+
+        data = DetectorInput.of(data, columns)
+        X = data.select(self.model.columns)
+        idx = self.model.lookup(data.timeindex_bin)
+        location, scale = self.model.gather(idx, 'location', 'scale')
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mzscore = np.abs((0.6745*(X - location)) / scale)
+        mzscore[np.isinf(mzscore)] = 1
         
-        return zscore
+        return _unknown_nan(aggr(mzscore), idx)
     
 #
 # MahalanobisDistance
 #
-class MahalanobisDistance(AnomalyDetector):
-    def __init__(self):
-        super().__init__(column_name='mahalanobis')
-        self.model = None
-        self.mean = None
-        self.inv_cov_matrix = None
-
-    def _calculate_mahalanobis(self, group):
-        if len(group) == 1:
-            group[self.column_name] = 0
-            return group[[]]
-
-        features = group
-        # Calculate mean and inverse covariance matrix for the group
-        mean_vector = features.mean().values
-        cov_matrix = np.cov(features, rowvar=False)
+def _inverse(cov):
+    """Inverses of a stack of covariance matrices, falling back to the pseudo-inverse for singular ones."""
+    try:
+        return np.linalg.inv(cov)
+    except np.linalg.LinAlgError:
+        pass
 
-        # Attempt to invert the covariance matrix
+    inv = np.empty_like(cov)
+    for i, matrix in enumerate(cov):
         try:
-            inv_cov_matrix = np.linalg.inv(cov_matrix)
+            inv[i] = np.linalg.inv(matrix)
         except np.linalg.LinAlgError:
-            # Fall back to pseudo-inverse if standard inversion fails
-            inv_cov_matrix = np.linalg.pinv(cov_matrix)
-        
-        # Calculate Mahalanobis distance for each row in the group
-        group[self.column_name] = features.apply(
-            lambda row: mahalanobis(row, mean_vector, inv_cov_matrix),
-            axis=1
-        )
+            inv[i] = np.linalg.pinv(matrix)
+    return inv
+
+def _mahalanobis(X, location, precision, idx, chunksize=2**16):
+    """
+    Mahalanobis distance of every row of `X` to the bin `idx` of the stacked `location`/`precision` arrays.
+
+    Evaluated as one quadratic form per chunk of rows, NaN for rows with `idx == -1` (unknown bin).
+    """
+    result = np.full(len(X), np.nan)
+    known = np.flatnonzero(idx >= 0)
+
+    for start in range(0, len(known), chunksize):
+        rows = known[start:start + chunksize]
+        deviations = X[rows] - location[idx[rows]]
+        result[rows] = np.einsum('ni,nij,nj->n', deviations, precision[idx[rows]], deviations)
+
+    return np.sqrt(result)
 
-        return group
+class MahalanobisDistance(AnomalyDetector):
+    incremental = True
+
+    def __init__(self, refit=True):
+        super().__init__(column_name='mahalanobis', refit=refit)
+        self.model = None
 
-    def fit(self, df, columns, verbose):
-        self.model = df[columns[0]].copy()
+    def fit(self, data, columns, verbose):
+        self.model = None
+        return self.partial_fit(data, columns)
+
+    def partial_fit(self, data, columns):
+        data = DetectorInput.of(data, columns)
         self.columns = columns
-        col_time = 'timeindex_bin'
-        featcols = columns[1]
+        X = data.select(columns[1])
+
+        moments = _update_moments(self.model, SegmentIndex(data.timeindex_bin), X, comoment=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = moments['comoment'] / (moments['count'] - 1)[:, None, None]
+
+        # Bins with a single row have no covariance, give them a zero precision so their distance is 0
+        single = moments['count'] <= 1
+        cov[single] = np.eye(X.shape[1])
+        precision = _inverse(cov)
+        precision[single] = 0
 
-        self.model = df.groupby(col_time)[featcols].apply(self._calculate_mahalanobis)
-        self.model = self.model[featcols + [self.column_name]].reset_index()
+        self.model = BinProfile(moments.pop('bins'), columns[1], precision=precision, **moments)
 
         return self
 
-    def score(self, df, columns):
+    def score(self, data, columns):
         if self.model is None:
             raise ValueError("Model has not been fitted yet.")
+
+        data = DetectorInput.of(data, columns)
+        X = data.select(self.model.columns)
+        idx = self.model.lookup(data.timeindex_bin)
         
-        return self.model[self.column_name]
+        return _mahalanobis(X, self.model['location'], self.model['precision'], idx)
+
 #
-# robustMahalanobisDistance
+# RobustMahalanobisDistance
 #
+def _fit_mincovdet(X, random_state):
+    """Location and precision of a minimum covariance determinant fit, zero precision if there are too few rows."""
+    if len(X) <= X.shape[1]:
+        return X.mean(axis=0), np.zeros((X.shape[1], X.shape[1]))
+
+    mcd = MinCovDet(random_state=random_state).fit(X)
+    return mcd.location_, mcd.precision_
+
+class RobustMahalanobisDistance(AnomalyDetector):
+    """
+    Mahalanobis distance using a minimum covariance determinant estimate per 'timeindex_bin'.
+
+    :param window: int, number of consecutive bins that share one estimate
+    :param n_jobs: int, number of worker processes for the per-window fits (None for all cores)
+    """
+    def __init__(self, window=1, n_jobs=None, random_state=42, refit=True):
+        super().__init__(column_name='robust_mahalanobis', refit=refit)
+        self.window = window
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def parallelism(self, stage=None):
+        # The distances are computed in a single process
+        return 1 if stage == 'score' else _cores(self.n_jobs)
+
+    def fit(self, data, columns, verbose):
+        data = DetectorInput.of(data, columns)
+        self.columns = columns
+        segments = SegmentIndex(data.timeindex_bin)
+        X = segments.sort(data.select(columns[1])).astype(np.float64, copy=False)
+
+        # Rows of every window of bins are a contiguous slice of the sorted features
+        bounds = range(0, len(segments), self.window)
+        windows = [X[segments.starts[b]:segments.ends[min(b + self.window, len(segments)) - 1]] for b in bounds]
+
+        if self.parallelism('fit') == 1:
+            fits = [_fit_mincovdet(x, self.random_state) for x in windows]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.parallelism('fit')) as executor:
+                fits = list(executor.map(_fit_mincovdet, windows, repeat(self.random_state)))
+
+        # Spread the per-window estimates onto the bins
+        perbin = np.arange(len(segments)) // self.window
+        location = np.stack([loc for loc, _ in fits])[perbin]
+        precision = np.stack([prec for _, prec in fits])[perbin]
+
+        self.model = BinProfile(segments.labels, columns[1], location=location, precision=precision)
+
+        return self
+
+    def score(self, data, columns):
+        if self.model is None:
+            raise ValueError("Model has not been fitted yet.")
+
+        data = DetectorInput.of(data, columns)
+        X = data.select(self.model.columns)
+        idx = self.model.lookup(data.timeindex_bin)
+
+        return _mahalanobis(X, self.model['location'], self.model['precision'], idx)
 
-    
 #
 # LOF
 #
+def _fit_lof(X, n_neighbors, n_jobs=None):
+    """LocalOutlierFactor in novelty mode fitted on `X`, None if there are too few rows for a neighbourhood."""
+    if len(X) < 2:
+        return None
+
+    return LocalOutlierFactor(n_neighbors=min(n_neighbors, len(X) - 1), novelty=True, n_jobs=n_jobs).fit(X)
+
 class LOF(AnomalyDetector):
-    def __init__(self, n_neighbors=20, name="lof"):
-        super().__init__(column_name=f"{name}_{n_neighbors}")
-        self.model = LocalOutlierFactor(n_neighbors=n_neighbors)
+    """
+    Local outlier factor on 'timeindex' and the feature columns.
+
+    Without a window, a single LocalOutlierFactor is fitted on all rows. With a window, the bins are split into
+    windows of `window` consecutive 'timeindex_bin' values, and every window gets its own LocalOutlierFactor
+    fitted on its rows plus the rows of `overlap` bins on either side. The windows are fitted in parallel, and
+    a row is scored by the window its bin belongs to.
+
+    :param window: int, number of bins per window (None for a single model over all rows)
+    :param overlap: int, number of neighbouring bins added on either side of a window (default window // 2)
+    :param n_jobs: int, number of worker processes for the window fits, or jobs of the single model
+    """
+    def __init__(self, n_neighbors=20, name="lof", window=None, overlap=None, n_jobs=None, refit=True):
+        super().__init__(column_name=f"{name}_{n_neighbors}", refit=refit)
+        self.n_neighbors = n_neighbors
+        self.window = window
+        self.overlap = overlap
+        self.n_jobs = n_jobs
+        self.bins = None
         self.scores = None
 
-    def fit(self, df, columns, verbose):
-        X = df[["timeindex"] + columns[1]]
+    def parallelism(self, stage=None):
+        # A single LocalOutlierFactor uses one job by default, the window fits all cores but score in a single process
+        if self.window is not None and stage == 'score':
+            return 1
+        return _cores(self.n_jobs, 1 if self.window is None else -1)
+
+    def fit(self, data, columns, verbose):
+        data = DetectorInput.of(data, columns)
+        self.columns = columns
+        X = data.with_time(columns[1])
+
+        if self.window is None:
+            self.model = _fit_lof(X, self.n_neighbors, self.n_jobs)
+            self.scores = -self.model.negative_outlier_factor_
+            return self
+
+        segments = SegmentIndex(data.timeindex_bin)
+        X = segments.sort(X)
+        overlap = self.window // 2 if self.overlap is None else self.overlap
+        windows = range(0, len(segments), self.window)
+
+        # Every window is fitted on its own bins plus the overlapping bins, all contiguous slices of the sorted rows
+        starts = [segments.starts[max(b - overlap, 0)] for b in windows]
+        ends = [segments.ends[min(b + self.window + overlap, len(segments)) - 1] for b in windows]
+        slices = [X[start:end] for start, end in zip(starts, ends)]
+
+        if self.parallelism('fit') == 1:
+            self.model = [_fit_lof(x, self.n_neighbors) for x in slices]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.parallelism('fit')) as executor:
+                self.model = list(executor.map(_fit_lof, slices, repeat(self.n_neighbors)))
+        self.bins = segments.labels
+
+        # The training score of a row comes from the window its bin belongs to
+        scores = np.ones(len(X))
+        for b, start, model in zip(windows, starts, self.model):
+            home_start = segments.starts[b]
+            home_end = segments.ends[min(b + self.window, len(segments)) - 1]
+            if model is not None:
+                offset = home_start - start
+                scores[home_start:home_end] = -model.negative_outlier_factor_[offset:offset + home_end - home_start]
+
+        self.scores = np.empty(len(X))
+        self.scores[segments.order] = scores
 
-        self.model.fit(X.values)
-        self.scores = -self.model.negative_outlier_factor_
         return self
 
-    def score(self, df, columns):
+    def score(self, data, columns):
+        """Novelty scores of (unseen) rows against the fitted neighbourhoods, NaN for bins outside the fitted windows."""
         if self.model is None:
             raise ValueError("Model has not been fitted yet.")
-        
-        return pd.Series(self.scores, index=df.index)
+
+        data = DetectorInput.of(data, columns)
+        X = data.with_time(self.columns[1])
+
+        if self.window is None:
+            return -self.model.score_samples(X)
+
+        idx = BinProfile(self.bins, self.columns[1]).lookup(data.timeindex_bin)
+        windows = np.where(idx >= 0, idx // self.window, -1)
+
+        scores = np.full(len(X), np.nan)
+        for w in np.unique(windows[windows >= 0]):
+            rows = windows == w
+            scores[rows] = 1.0 if self.model[w] is None else -self.model[w].score_samples(X[rows])
+
+        return scores
+
+    def score_fitted(self, data, columns):
+        return self.scores
+
+#
+# LOFSweep
+#
+def _reachability_density(distances, indices, kdistances):
+    """Local reachability density of points with neighbours `indices` at `distances`, as LocalOutlierFactor."""
+    return 1.0 / (np.mean(np.maximum(distances, kdistances[indices]), axis=1) + 1e-10)
+
+class LOFSweep(AnomalyDetector):
+    """
+    Local outlier factor for several `n_neighbors` at once, one result column per value ('lof_5', 'lof_10', ...).
+
+    The k-NN graph is computed once for the largest k, the scores of every smaller k are derived from its first
+    k neighbours with the same formulas as LocalOutlierFactor.
+    """
+    def __init__(self, n_neighbors=(5, 10, 20), name="lof", n_jobs=None, refit=True):
+        super().__init__(column_name=name, refit=refit)
+        self.column_names = [f"{name}_{k}" for k in n_neighbors]
+        self.n_neighbors = list(n_neighbors)
+        self.n_jobs = n_jobs
+        self.distances = None
+        self.lrds = None
+        self.scores = None
+
+    def parallelism(self, stage=None):
+        return _cores(self.n_jobs, 1)
+
+    def fit(self, data, columns, verbose):
+        data = DetectorInput.of(data, columns)
+        self.columns = columns
+        X = data.with_time(columns[1])
+        ks = [min(k, len(X) - 1) for k in self.n_neighbors]
+
+        self.model = NearestNeighbors(n_neighbors=max(ks), n_jobs=self.n_jobs).fit(X)
+        self.distances, indices = self.model.kneighbors()
+
+        self.lrds, scores = [], []
+        for k in ks:
+            lrd = _reachability_density(self.distances[:, :k], indices[:, :k], self.distances[:, k - 1])
+            self.lrds += [lrd]
+            scores += [np.mean(lrd[indices[:, :k]] / lrd[:, np.newaxis], axis=1)]
+
+        self.scores = np.column_stack(scores)
+        return self
+
+    def score(self, data, columns):
+        """Novelty scores of (unseen) rows against the fitted k-NN graph, as LocalOutlierFactor(novelty=True)."""
+        if self.model is None:
+            raise ValueError("Model has not been fitted yet.")
+
+        data = DetectorInput.of(data, columns)
+        X = data.with_time(self.columns[1])
+        distances, indices = self.model.kneighbors(X)
+
+        scores = []
+        for k, lrd in zip(self.n_neighbors, self.lrds):
+            k = min(k, self.distances.shape[1])
+            X_lrd = _reachability_density(distances[:, :k], indices[:, :k], self.distances[:, k - 1])
+            scores += [np.mean(lrd[indices[:, :k]] / X_lrd[:, np.newaxis], axis=1)]
+
+        return np.column_stack(scores)
+
+    def score_fitted(self, data, columns):
+        return self.scores
 
 #
 # IF
 #   
+def _average_path_length(n_samples):
+    """Average path length of an unsuccessful search in a binary search tree of `n_samples` points, as IsolationForest."""
+    n_samples = np.asarray(n_samples, dtype=float)
+    path_length = 2.0 * (np.log(np.maximum(n_samples - 1.0, 1.0)) + np.euler_gamma) - 2.0 * (n_samples - 1.0) / np.maximum(n_samples, 1.0)
+    return np.select([n_samples <= 1, n_samples == 2], [0.0, 1.0], path_length)
+
+class _Forest:
+    """
+    The trees of a fitted IsolationForest as flat node arrays, scored with a vectorized traversal of a chunk of rows
+    per tree level. Every array is a .npy file of a stored forest that `load` can memory-map, such that scoring only
+    reads the pages of the nodes it visits. The nodes of a tree are numbered level by level with the right child of
+    a node right before its left child, so a row moves from a node to `child + (x <= threshold)`. Leaves have
+    threshold inf and the node before them as child, such that rows stay in them, and every tree is walked down to
+    its depth.
+
+    :param child: array, index within its tree of the right child of every node of all trees, the left child follows
+    :param feature: array, input column split on by every node
+    :param threshold: array, split threshold of every node (rows <= threshold go left), inf for leaves
+    :param value: array, path length of a row that ends in the node (leaves only), as IsolationForest
+    :param roots: array, index of the root (the first node) of every tree
+    :param depths: array, depth of every tree
+    :param denominator: float, number of trees times the average path length of the training sample
+    """
+    ARRAYS = ('child', 'feature', 'threshold', 'value', 'roots', 'depths')
+    # The scikit-learn versions (from, up to) whose IsolationForest scores are reproduced, see `of`
+    SKLEARN_VERSIONS = ((1, 0), (1, 6))
+    CHUNKSIZE = 2**14
+
+    def __init__(self, child, feature, threshold, value, roots, depths, denominator):
+        self.child, self.feature, self.threshold, self.value = child, feature, threshold, value
+        self.roots, self.depths = roots, depths
+        self.denominator = denominator
+
+    @classmethod
+    def of(cls, forest):
+        """
+        The node arrays of a fitted IsolationForest, with the feature subsets of its trees resolved. Raises a
+        RuntimeError for a scikit-learn version outside `SKLEARN_VERSIONS`, whose scores may be computed differently.
+        """
+        version = tuple(int(part) for part in sklearn.__version__.split('.')[:2])
+        (low, high) = cls.SKLEARN_VERSIONS
+        if not low <= version < high:
+            raise RuntimeError(f"IF.save supports scikit-learn {low[0]}.{low[1]} up to {high[0]}.{high[1]} (exclusive), "
+                               f"found {sklearn.__version__}.")
+
+        arrays = {name : [] for name in cls.ARRAYS[:4]}
+        for estimator, features in zip(forest.estimators_, forest.estimators_features_):
+            tree = estimator.tree_
+            leaf = tree.children_left == -1
+
+            # Number the nodes level by level, every right child right before its left sibling
+            levels = [np.zeros(1, dtype=np.intp)]
+            while len(inner := levels[-1][~leaf[levels[-1]]]):
+                levels += [np.column_stack([tree.children_right[inner], tree.children_left[inner]]).ravel()]
+            order = np.concatenate(levels)
+            index = np.empty_like(order)
+            index[order] = np.arange(len(order))
+            depth = np.repeat(np.arange(1, len(levels) + 1), [len(level) for level in levels])
+            leaf = leaf[order]
+
+            arrays['child'] += [np.where(leaf, np.arange(len(order)) - 1, index[tree.children_right[order]])]
+            arrays['feature'] += [np.where(leaf, 0, np.asarray(features)[np.maximum(tree.feature[order], 0)])]
+            arrays['threshold'] += [np.where(leaf, np.inf, tree.threshold[order])]
+            arrays['value'] += [depth + _average_path_length(tree.n_node_samples[order]) - 1.0]
+
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        return cls(**{name : np.concatenate(values) for name, values in arrays.items()},
+                   roots=np.r_[0, np.cumsum([tree.node_count for tree in trees])[:-1]],
+                   depths=np.array([tree.max_depth for tree in trees]),
+                   denominator=len(trees) * _average_path_length([forest.max_samples_])[0])
+
+    def score_samples(self, X):
+        """Opposite of the anomaly score of every row of `X`, as `IsolationForest.score_samples`."""
+        X = np.asarray(X, dtype=np.float32)
+        bounds = np.r_[self.roots, len(self.child)]
+        trees = [[np.asarray(array[start:stop]) for array in (self.child, self.feature, self.threshold, self.value)] + [depth]
+                 for start, stop, depth in zip(bounds[:-1], bounds[1:], self.depths)]
+
+        depths = np.zeros(len(X))
+        for start in range(0, len(X), self.CHUNKSIZE):
+            # The value of row i of the chunk in column j is at j * len(chunk) + i of its flat columns
+            chunk = X[start:start + self.CHUNKSIZE]
+            columns, rows = chunk.T.ravel(), np.arange(len(chunk))
+            for child, feature, threshold, value, depth in trees:
+                offset = feature * len(chunk)
+                node = np.zeros(len(chunk), dtype=np.intp)
+                for _ in range(depth):
+                    node = child[node] + (columns[offset[node] + rows] <= threshold[node])
+                depths[start:start + len(chunk)] += value[node]
+
+        # For a single training row, the denominator and the depths are 0 and the score is 1
+        return -2 ** -np.divide(depths, self.denominator, out=np.ones_like(depths), where=self.denominator != 0)
+
+    def save(self, path, **meta):
+        """Store the arrays in the directory `path`, with the denominator and `meta` in its meta.json."""
+        os.makedirs(path, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(dict(meta, denominator=float(self.denominator)), f)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """The stored forest, with its arrays memory-mapped with `mmap_mode`, and the meta of `save`."""
+        arrays = {name : np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in cls.ARRAYS}
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        return cls(**arrays, denominator=meta.pop('denominator')), meta
+
 class IF(AnomalyDetector):
-    def __init__(self, n_neighbors=20):
-        super().__init__(column_name='if')
-        self.model = IsolationForest(n_estimators = 500, contamination = 0.02, random_state = 42, n_jobs = -1)
-
-    def fit(self, df, columns, verbose):
-        X = df[['timeindex'] + columns[1]]
-        self.model.fit(X.values)
-        self.scores = self.model.score_samples(X.values)
+    """
+    Isolation forest on 'timeindex' and the feature columns.
+
+    The trained forest can be saved with `save` and loaded with `IF.load`, after which new frames are scored without
+    retraining. The stored forest is a directory of node arrays that are memory-mapped on load. Scoring runs in
+    parallel over chunks of rows.
+
+    :param subsample: int or float, number (or fraction) of rows the forest is trained on (None for all rows)
+    :param n_jobs: int, number of jobs for training and scoring (-1 for all cores)
+    :param chunksize: int, number of rows per scoring chunk
+    """
+    def __init__(self, n_neighbors=20, subsample=None, n_jobs=-1, chunksize=2**16, refit=True):
+        super().__init__(column_name='if', refit=refit)
+        self.subsample = subsample
+        self.n_jobs = n_jobs
+        self.chunksize = chunksize
+
+    def parallelism(self, stage=None):
+        return _cores(self.n_jobs)
+
+    def fit(self, data, columns, verbose):
+        data = DetectorInput.of(data, columns)
+        self.columns = columns
+        X = data.with_time(columns[1])
+
+        if self.subsample is not None:
+            size = self.subsample if isinstance(self.subsample, int) else round(len(X) * self.subsample)
+            X = X[np.random.default_rng(42).choice(len(X), min(size, len(X)), replace=False)]
+
+        self.model = IsolationForest(n_estimators = 500, contamination = 0.02, random_state = 42, n_jobs = self.n_jobs)
+        self.model.fit(X)
         return self
 
-    def score(self, df, columns):
+    def score(self, data, columns):
         if self.model is None:
             raise ValueError("Model has not been fitted yet.")  
-        
-        return pd.Series(self.scores, index=df.index)
-    
+
+        data = DetectorInput.of(data, columns)
+        X = data.with_time(self.columns[1])
+        chunks = [X[start:start + self.chunksize] for start in range(0, len(X), self.chunksize)]
+
+        # The tree traversals release the GIL, so the chunks are scored in threads sharing the forest
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallelism('score')) as executor:
+            scores = list(executor.map(self.model.score_samples, chunks))
+
+        return np.concatenate(scores) if scores else np.zeros(0)
+
+    def save(self, path):
+        """Store the trained forest as node arrays and the columns in the directory `path`, see `load`."""
+        forest = self.model if isinstance(self.model, _Forest) else _Forest.of(self.model)
+        forest.save(path, columns=[list(c) for c in self.columns])
+
+    @classmethod
+    def load(cls, path, mmap_mode='r', **kwargs):
+        """IF scoring with a stored forest, memory-mapped with `mmap_mode` (None reads it), not retrained by `fit_score`."""
+        detector = cls(refit=False, **kwargs)
+        detector.model, meta = _Forest.load(path, mmap_mode)
+        detector.columns = tuple(meta['columns'])
+        return detector
+
+#
+# HMM
+#
+def _score_hmm(model, X, lengths):
+    """Per-row anomaly scores of the sequences in `X`: the negative posterior-weighted emission log-likelihood."""
+    _, posteriors = model.score_samples(X, lengths)
+    return -np.sum(posteriors * model._compute_log_likelihood(X), axis=1)
+
+class HMM(AnomalyDetector):
+    """
+    Gaussian mixture hidden Markov model over the sequences, ordered by 'timeindex_bin' within every 'seqid'.
+
+    The score of a bin is the negative log-likelihood of its features under the states, weighted by the posterior
+    state probabilities of the bin. Sequences are scored in parallel over worker processes.
+
+    :param n_jobs: int, number of worker processes for scoring (None for all cores)
+    """
+    def __init__(self, n_components=50, n_mix=1, covariance_type="full", n_iter=100, n_jobs=None, random_state=42, refit=True):
+        if GMMHMM is None:
+            raise ImportError("The HMM detector requires hmmlearn.")
+
+        super().__init__(column_name='hmm', refit=refit)
+        self.n_components = n_components
+        self.n_mix = n_mix
+        self.covariance_type = covariance_type
+        self.n_iter = n_iter
+        self.n_jobs = n_jobs
+        self.random_state = random_state
+
+    def parallelism(self, stage=None):
+        # Baum-Welch runs in a single process, only the scoring is spread over the workers
+        return 1 if stage == 'fit' else _cores(self.n_jobs)
+
+    def fit(self, data, columns, verbose):
+        data = DetectorInput.of(data, columns)
+        self.columns = columns
+        segments = SegmentIndex(data.seqid, data.timeindex_bin)
+        X = segments.sort(data.select(columns[1])).astype(np.float64, copy=False)
+
+        self.model = GMMHMM(n_components=self.n_components, n_mix=self.n_mix, covariance_type=self.covariance_type,
+                            n_iter=self.n_iter, random_state=self.random_state, verbose=verbose)
+        self.model.fit(X, lengths=segments.counts)
+
+        return self
+
+    def score(self, data, columns):
+        if self.model is None:
+            raise ValueError("Model has not been fitted yet.")
+
+        data = DetectorInput.of(data, columns)
+        segments = SegmentIndex(data.seqid, data.timeindex_bin)
+        X = segments.sort(data.select(self.columns[1])).astype(np.float64, copy=False)
+
+        # Chunks of whole sequences, several per worker to balance sequences of different lengths
+        workers = self.parallelism('score')
+        chunks = [c for c in np.array_split(np.arange(len(segments)), min(len(segments), workers * 4)) if len(c)]
+        bounds = [(segments.starts[c[0]], segments.ends[c[-1]]) for c in chunks]
+        lengths = [segments.counts[c] for c in chunks]
+
+        if workers == 1:
+            scores = [_score_hmm(self.model, X[start:end], l) for (start, end), l in zip(bounds, lengths)]
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                scores = list(executor.map(_score_hmm, repeat(self.model), [X[start:end] for start, end in bounds], lengths))
+
+        result = np.empty(len(X))
+        result[segments.order] = np.concatenate(scores) if scores else np.zeros(0)
+
+        return result
@@ -1,28 +1,108 @@
 import pickle
+import numpy as np
 import pandas as pd
 import concurrent.futures
+import os
+import threading
+import time
 
 from typing import Self
 from datetime import datetime
-from functools import reduce
-from sklearn.metrics import precision_recall_curve, auc, roc_curve
+from contextlib import contextmanager, nullcontext
 from concurrent.futures import wait, FIRST_COMPLETED
 
-import pickle
-import pandas as pd
-import concurrent.futures
-import os
+from multiprocessing import shared_memory
 
-from typing import Self
-from datetime import datetime
-from functools import reduce
-from sklearn.metrics import precision_recall_curve, auc, roc_curve
-from concurrent.futures import wait, FIRST_COMPLETED
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
+import aggregators as agg
 import anomalydetectors as m
+import metrics
+import resultstore
+from segments import SegmentIndex
+from instrumentation import Recorder, export_trace, cpu_time, thread_cpu_time
 #import src.utils.globals as g
 #from src.utils.plotting import plot_rpcurves
 
+# Serializes the progress updates of the model threads
+_progress_lock = threading.Lock()
+
+class CoreScheduler:
+    """
+    Hands out the cores of a fixed budget to work units, so the running units together never use more cores than
+    the budget. A unit asks for the cores its detector can use and waits until at least one core is free, then
+    gets as many of its requested cores as are free at that moment.
+    """
+    def __init__(self, cores=None):
+        self.cores = cores or os.cpu_count()
+        self.free = self.cores
+        self.condition = threading.Condition()
+
+    def acquire(self, demand):
+        with self.condition:
+            self.condition.wait_for(lambda : self.free > 0)
+            granted = max(1, min(demand, self.free))
+            self.free -= granted
+            return granted
+
+    def release(self, cores):
+        with self.condition:
+            self.free += cores
+            self.condition.notify_all()
+
+    @contextmanager
+    def allot(self, demand):
+        cores = self.acquire(demand)
+        try:
+            yield cores
+        finally:
+            self.release(cores)
+
+class StageAllotment:
+    """
+    The `step` of `AnomalyDetector.fit_score` that runs every stage of `model` on cores of `scheduler`, as many as
+    the detector uses in that stage (see `AnomalyDetector.parallelism`), and inside the stage of `step` if given.
+    The cores are released between the stages, e.g. a detector with a serial fit holds a single core while fitting.
+    Other stages (e.g. 'cache') take one core. `capacity` and `wall` add up the allotted core-seconds and the wall
+    time of all stages, `waited` the time spent waiting for the cores.
+    """
+    def __init__(self, scheduler, model, step=None):
+        self.scheduler = scheduler
+        self.model = model
+        self.step = step or (lambda stage : nullcontext())
+        self.capacity = 0.0
+        self.wall = 0.0
+        self.waited = 0.0
+
+    @contextmanager
+    def __call__(self, stage):
+        # The demand is that of the detector's own n_jobs, not of the cores of the previous stage
+        self.model.set_parallelism(None)
+        demand = self.model.parallelism(stage) if stage in ('fit', 'score') else 1
+
+        start = time.perf_counter()
+        with self.scheduler.allot(demand) as cores, self.step(stage):
+            self.waited += time.perf_counter() - start
+            self.model.set_parallelism(cores)
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                wall = time.perf_counter() - start
+                self.wall += wall
+                self.capacity += wall * cores
+
+    def timing(self, wall):
+        """
+        Wall time without the waits, the waits and the average allotted cores of a unit that took `wall` seconds.
+        The time outside the stages counts as one core.
+        """
+        wall = max(wall - self.waited, 0)
+        return wall, self.waited, (self.capacity + max(wall - self.wall, 0)) / wall if wall > 0 else 1.0
+
 class Experiment:
     def __init__(self, name : str, path : str):
         self.name = name
@@ -37,37 +117,89 @@ class Experiment:
             'roc' : {},
             'auc-pr' : {},
             'auc-roc' : {},
+            'timings' : pd.DataFrame(),
+            'auc-ci' : pd.DataFrame(),
+            'auc-diff' : pd.DataFrame(),
+            'steps' : pd.DataFrame(),
         }
         self.progress = pd.DataFrame()
         self.anomalies = pd.DataFrame()
         self.model_names =[]
+        self.series = pd.DataFrame()
+        self.sample = None
 
-    def run(self, df, models : list[m.AnomalyDetector], columns : tuple[list[str], list[str]], spliton=None, verbose=False):
-        self.results['df'] = df[columns[0] + ['timeindex'] + columns[1]].copy()
-        dfs = [df]
-        self.model_names = [model.name for model in models]
+    def run(self, df, models : list[m.AnomalyDetector], columns : tuple[list[str], list[str]], spliton=None, verbose=False, executor='thread', max_workers=None, cache=None, memory=False, stream=None):
+        """
+        Fit and score every model on `df`, per group of `spliton` if given. The scores are stored in results['df'],
+        with the key columns, 'timeindex' and the features of every row of `df`.
 
+        With executor 'thread', every model runs in its own thread over the groups. The models are started in order of
+        their parallelism, and every stage of every group takes cores from a budget of `max_workers` cores (default
+        all cores), as many as the detector uses in that stage, which also size the detector's own n_jobs (see
+        `StageAllotment`). With executor 'process', every (model, group) pair is a work unit on a pool of `max_workers`
+        processes, reading the features from shared memory, with the cores split over the units. The fitted models
+        then stay in the worker processes, only the scores are gathered.
+
+        The wall time, time waited for cores, CPU time and average allotted cores of every (model, group) are stored
+        in results['timings'], see `timings`.
+        The wall time, CPU time, rows/s and peak memory (if `memory`) of every (model, group, stage) step are stored
+        in results['steps'], see `instrumentation.Recorder` and `trace`. A `StreamingAggregator` as `stream` gets the
+        scores of every model as soon as the model is done. With a `ScoreCache` as `cache`, every (model, group) whose
+        detector and input are unchanged reads its scores from the cache instead of fitting.
+        """
+        self.model_names = [name for model in models for name in model.column_names]
+
+        # One read-only copy of the features, ordered such that every split group is a contiguous slice (a view)
+        rows, bounds = np.arange(len(df)), [(0, len(df))]
         if spliton:
-            dfs = [group for _, group in df.groupby(spliton)]
+            groups = SegmentIndex(df[spliton])
+            rows, bounds = groups.order, list(zip(groups.starts, groups.ends))
+
+        data = m.DetectorInput.from_frame(df, columns, None if not spliton else rows)
+        dfs = [data.slice(start, stop) for start, stop in bounds]
+
+        # Results frame indexed by an integer (seqid, timeindex_bin) key, the scores of every model are scattered
+        # into preallocated columns by row position. The features are kept for the plots, the detectors read `data`.
+        self.results['df'] = df[columns[0] + ['timeindex'] + columns[1]].set_axis(self.key(df), axis=0)
+        self._rows, self._bounds = rows, bounds
+        self._scores = {name : np.full(len(df), np.nan) for name in self.model_names}
+        self._stream = stream
 
         if verbose:
             self.progress = pd.DataFrame({model.name: [f"0/{len(dfs)}"] for model in models})
             #print(self.progress.to_string(index=False))
 
+        self._timings = []
+        scheduler = CoreScheduler(max_workers)
+        recorder = Recorder(memory)
+
+        if executor == 'process':
+            return self._run_processes(data, bounds, models, columns, verbose, scheduler, cache, recorder)
+
         # Let's for every method apply a futures thing...
         def model_fit_scores(name, model, dfs, columns, verbose):
             print(f"model_fit_scores {name} for {len(dfs)} on {columns}")
             r = []
-            for df in dfs:
-                r += [model.fit_score(df, columns, verbose)]
-                self.verbose_progress(name, len(dfs))
+            for group, df in enumerate(dfs):
+                step = StageAllotment(scheduler, model, recorder.stepper(name, group, len(df)))
+                start, cpu = time.perf_counter(), thread_cpu_time()
+                r += [cache.fit_score(model, df, columns, step) if cache else model.fit_score(df, columns, False, step)]
+                wall, cpu = time.perf_counter() - start, thread_cpu_time() - cpu
+                wall, wait, cores = step.timing(wall)
+                self._timings += [(name, group, cores, wall, wait, cpu)]
+
+                if verbose:
+                    self.verbose_progress(name, len(dfs))
 
+            model.set_parallelism(None)
             return r
         
-        
-        with concurrent.futures.ThreadPoolExecutor() as executor:
+        # Multi-core detectors first, such that the single-core detectors fill up the remaining cores
+        models = sorted(models, key=lambda model : -model.parallelism())
+
+        with recorder.tracing(), concurrent.futures.ThreadPoolExecutor(max_workers=len(models)) as executor:
             futures = {
-                executor.submit(model_fit_scores, model.name, model, dfs, columns, False) : model.name 
+                executor.submit(model_fit_scores, model.name, model, dfs, columns, verbose) : model
                 for model in models
             }
 
@@ -77,73 +209,325 @@ class Experiment:
 
                 for future in done:
 
-                    # Retrieve the model name and result
-                    name = futures[future]
-                    results = pd.concat(future.result())
-
-                    self.results['df'] = self.results['df'].merge(results, on=columns[0], how='left')
+                    # Retrieve the model and its scores, one array per split group
+                    model = futures[future]
+                    self._add_scores(model, future.result())
 
                     # Remove the processed future from the futures dict
                     del futures[future]
 
+        self.results['timings'] = pd.DataFrame(self._timings, columns=['model', 'group', 'cores', 'wall', 'wait', 'cpu'])
+        self.results['steps'] = recorder.frame()
         return self
 
-    def calculate_metrics(self, aggrfunc, df_anomalous=pd.DataFrame()):     
-        if df_anomalous.empty:
-            df_anomalous = self.anomalies
+    def _run_processes(self, data, bounds, models, columns, verbose, scheduler, cache, recorder):
+        blocks, shared = _share(data)
 
-        # Calculate series df here
-        dfs_series = []
-        for model in self.model_names:
-            dfs_series += [aggrfunc(self.results['df'], [model])]
+        # The units run side by side, every unit gets an equal share of the cores
+        workers = min(scheduler.cores, len(models) * len(bounds))
+        share = max(1, scheduler.cores // workers)
 
-        df_series = reduce(lambda x, y: pd.merge(x, y, on = 'seqid'), dfs_series)
-        df = pd.merge(df_series, df_anomalous, on='seqid')
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                # One work unit per (model, group), submitted model by model so the first models complete first.
+                # The model is pickled when the unit is dispatched, so its share is applied in the worker.
+                futures = []
+                for model in models:
+                    futures += [[
+                        executor.submit(_fit_score_unit, model, columns, shared, start, stop, cache, group, recorder.memory, share)
+                        for group, (start, stop) in enumerate(bounds)
+                    ]]
+                    if verbose:
+                        for future in futures[-1]:
+                            future.add_done_callback(lambda _, name=model.name: self.verbose_progress(name, len(bounds)))
 
-        self.results['df_agg'] = df
+                # Gather in order, the scores of a model are complete once all its groups are
+                for model, group_futures in zip(models, futures):
+                    results = [future.result() for future in group_futures]
+                    self._add_scores(model, [scores for scores, _, _, _ in results])
+                    self._timings += [(model.name, group, *timing, cpu) for group, (_, timing, cpu, _) in enumerate(results)]
+                    for _, _, _, steps in results:
+                        recorder.extend(steps)
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+        self.results['timings'] = pd.DataFrame(self._timings, columns=['model', 'group', 'cores', 'wall', 'wait', 'cpu'])
+        self.results['steps'] = recorder.frame()
+        return self
+
+    def timings(self):
+        """
+        Per model wall time, time waited for cores and CPU time of the last run, and the fraction of its allotted
+        cores it kept busy. The wall time leaves out the waits. With executor 'process' the CPU time is that of the
+        worker process and its child processes (see `instrumentation.cpu_time`). With executor 'thread' it is that
+        of the model's thread and of the waited-for child processes (see `instrumentation.thread_cpu_time`): the
+        process pools of a detector count, but threads it starts itself (e.g. of IF) do not.
+        """
+        timings = self.results['timings'].assign(capacity=lambda t : t['wall'] * t['cores'])
+        summary = timings.groupby('model', sort=False)[['wall', 'wait', 'cpu', 'capacity']].sum()
+        summary['utilization'] = summary['cpu'] / summary.pop('capacity')
+
+        return summary.reset_index()
+
+    def _add_scores(self, model, scores):
+        """Scatter the scores of `model`, one array per split group, into its result columns."""
+        for (start, stop), group_scores in zip(self._bounds, scores):
+            group_scores = np.reshape(group_scores, (stop - start, -1))
+            for name, column in zip(model.column_names, group_scores.T):
+                self._scores[name][self._rows[start:stop]] = column
+
+        for name in model.column_names:
+            self.results['df'][name] = self._scores.pop(name)
+
+        if self._stream is not None:
+            self._stream.update_frame(self.results['df'], model.column_names)
+
+    @staticmethod
+    def key(df):
+        """Integer key of the (seqid, timeindex_bin) of every row of `df`."""
+        seqid, _ = pd.factorize(df['seqid'], sort=True)
+        timeindex_bin, bins = pd.factorize(df['timeindex_bin'], sort=True)
+
+        return pd.Index(seqid.astype(np.int64) * len(bins) + timeindex_bin, name='key')
+
+    def preview(self, df, models : list[m.AnomalyDetector], columns : tuple[list[str], list[str]], aggrfunc, fraction=0.1, strata=('robotid', 'anomaly_syn_type'), seed=42, n_replicates=1000, **kwargs):
+        """
+        Fast preview of `run` and `calculate_metrics` on a stratified sample of the sequences: `fraction` of the
+        sequences of every combination of `strata` (at least one), e.g. of every robot and anomaly type. The
+        metrics come with the bootstrap intervals of `bootstrap`, to tell whether a full run is worth it. The
+        keyword arguments go to `run` (e.g. spliton, executor or cache), the anomalies are those of `set_anomalies`.
+        """
+        # A sequence belongs to the anomaly type of any of its rows, the other strata are constant per sequence
+        strata = [column for column in strata if column in df]
+        sequences = df.groupby('seqid')[strata].max().reset_index() if strata else df[['seqid']].drop_duplicates()
+
+        rng = np.random.default_rng(seed)
+        groups = sequences.groupby(strata, sort=True) if strata else [(None, sequences)]
+        self.sample = np.concatenate([
+            rng.choice(group['seqid'].to_numpy(), max(1, round(len(group) * fraction)), replace=False)
+            for _, group in groups
+        ])
+
+        self.run(df[df['seqid'].isin(self.sample)], models, columns, **kwargs)
+        self.calculate_metrics(aggrfunc)
+        return self.bootstrap(n_replicates, seed=seed)
+
+    def run_partitioned(self, path, models : list[m.AnomalyDetector], columns : tuple[list[str], list[str]], aggrfunc, partition='robotid', label=None, output=None, verbose=False, max_workers=None, cache=None):
+        """
+        Out-of-core `run` over the Parquet dataset `path` (a file or a partitioned directory). The rows of every
+        value of `partition` are read, fitted and scored (as `run` with spliton=`partition`) one partition at a time.
+        The scores are appended to the Parquet file `output` if given, only their per sequence aggregates of
+        `aggrfunc` are kept, such that memory is bounded by the largest partition. `calculate_metrics` without an
+        aggrfunc then evaluates these aggregates. `aggrfunc` can also be a `StreamingAggregator`, that is updated
+        with the scores of every model of every partition as they are produced.
 
-        for name in self.model_names:
-                self.results['pr'][name]    = precision_recall_curve(df['anomalous'], df[name])
-                self.results['auc-pr'][name]  = auc(self.results['pr'][name][1], self.results['pr'][name][0])
+        The aggregates of an `aggrfunc` are those of one partition, so every sequence must lie within one partition:
+        a ValueError is raised for a sequence that was in an earlier one. A `StreamingAggregator` merges the scores
+        of a sequence over the partitions, with it sequences may span partitions.
 
-                self.results['roc'][name]   = roc_curve(df['anomalous'], df[name])
-                self.results['auc-roc'][name]  = auc(self.results['roc'][name][0], self.results['roc'][name][1])
+        :param label: str, boolean column whose any() per sequence is the ground truth, else see `set_anomalies`
+        """
+        dataset = ds.dataset(path, format='parquet', partitioning='hive')
+
+        values = set()
+        for batch in dataset.to_batches(columns=[partition]):
+            values.update(pc.unique(batch.column(0)).to_pylist())
+
+        read = list(dict.fromkeys(columns[0] + ['timeindex'] + columns[1] + ([label] if label else [])))
+        writer, series, anomalies, timings, steps, seqids = None, [], [], [], [], set()
+        origin = time.perf_counter()
+        stream = aggrfunc if isinstance(aggrfunc, agg.StreamingAggregator) else None
+
+        try:
+            for group, value in enumerate(sorted(values)):
+                df = dataset.to_table(columns=read, filter=pc.field(partition) == value).to_pandas()
+                if stream is None:
+                    repeated = seqids.intersection(df['seqid'].unique())
+                    if repeated:
+                        raise ValueError(f"The sequences {sorted(repeated)[:5]} span several values of {partition!r}, "
+                                         f"aggregate with a StreamingAggregator or partition on whole sequences.")
+                    seqids.update(df['seqid'].unique())
+
+                self.run(df, models, columns, max_workers=max_workers, cache=cache, stream=stream)
+
+                # Every run records from its own origin, the steps are shifted to the start of the partitioned run
+                timings += [self.results['timings'].assign(group=group)]
+                frame = self.results['steps']
+                steps += [frame.assign(group=group, start=frame['start'] + frame.attrs['origin'] - origin)]
+                if stream is None:
+                    series += [aggrfunc(self.results['df'], self.model_names)]
+                if label:
+                    anomalies += [df.groupby('seqid').agg(anomalous=(label, 'any')).reset_index()]
+
+                if output:
+                    # The models finish in any order, the score columns are written in model order
+                    scores = self.results['df'][columns[0] + ['timeindex'] + columns[1] + self.model_names]
+                    table = pa.Table.from_pandas(scores, preserve_index=False)
+                    if writer is None:
+                        writer = pq.ParquetWriter(output, table.schema)
+                    writer.write_table(table.cast(writer.schema))
+
+                self.results['df'] = pd.DataFrame()
+                if verbose:
+                    print(f"Partition {partition}={value} ({group + 1}/{len(values)}) done")
+        finally:
+            if writer is not None:
+                writer.close()
+
+        self.series = stream.frame() if stream is not None else pd.concat(series, ignore_index=True)
+        self.results['timings'] = pd.concat(timings, ignore_index=True)
+        self.results['steps'] = pd.concat(steps, ignore_index=True)
+        self.results['steps'].attrs['origin'] = origin
+        if label:
+            self.anomalies = pd.concat(anomalies, ignore_index=True).groupby('seqid', as_index=False)['anomalous'].any()
+
+        return self
+
+    def calculate_metrics(self, aggrfunc=None, df_anomalous=pd.DataFrame(), max_thresholds=None):
+        """
+        Aggregate the scores of all models per sequence in one call of `aggrfunc`, and compute the PR and ROC curves
+        and their AUCs of all models from one sort per model (see `metrics.evaluate`). With `max_thresholds`, the
+        stored curves keep at most that many thresholds, the AUCs are always of the full curves. Without an
+        `aggrfunc`, the aggregates kept by `run_partitioned` are evaluated.
+        """
+        if df_anomalous.empty:
+            df_anomalous = self.anomalies
+
+        series = self.series if aggrfunc is None else aggrfunc(self.results['df'], self.model_names)
+        df = pd.merge(series, df_anomalous, on='seqid')
+        self.results['df_agg'] = df
+
+        evaluated = metrics.evaluate(df['anomalous'].to_numpy(), df[self.model_names].to_numpy(), self.model_names, max_thresholds)
+        for key, values in evaluated.items():
+            self.results[key].update(values)
 
         return self
     
+    def bootstrap(self, n_replicates=1000, alpha=0.05, seed=42, n_jobs=None):
+        """
+        Bootstrap confidence intervals of the AUCs of every model and of the paired differences between the models,
+        from the per sequence scores of `calculate_metrics`. Stored in results['auc-ci'] and results['auc-diff'],
+        see `metrics.bootstrap`.
+        """
+        df = self.results['df_agg']
+        self.results['auc-ci'], self.results['auc-diff'] = metrics.bootstrap(
+            df['anomalous'].to_numpy(), df[self.model_names].to_numpy(), self.model_names, n_replicates, alpha, seed, n_jobs
+        )
+
+        return self
+
     def set_anomalies(self, df_anomalies):
         self.anomalies = df_anomalies
     
     def set_input(self, df_input):
         self.results['input'] = df_input
 
+    def trace(self, path):
+        """Write the steps of the last run as a Chrome trace, see `instrumentation.export_trace`."""
+        export_trace(self.results['steps'], path)
+
     def verbose_progress(self, method, total):
-        # Update
-        self.progress.at[0, method] = f"{int(self.progress.at[0, method].split('/')[0]) + 1}/{total}"
+        # The models report from their own threads, update and print one at a time
+        with _progress_lock:
+            # Update
+            self.progress.at[0, method] = f"{int(self.progress.at[0, method].split('/')[0]) + 1}/{total}"
 
-        # Clear & Print
-        #clear_output(wait=True)
-        print("\033[F\r" + self.progress.to_string(index=False))
+            # Clear & Print
+            #clear_output(wait=True)
+            print("\033[F\r" + self.progress.to_string(index=False))
 
         
     def pickle(self):
-        directory = os.path.dirname(self.path(self.folderpath, self.name))
-        if not os.path.exists(directory):
+        path = self.path(self.folderpath, self.name)
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
             os.makedirs(directory)
-        with open(self.path(self.folderpath, self.name), 'wb') as f:
+
+        # Write through a temporary file, an interrupted pickle never leaves a partial experiment behind
+        with open(path + '.tmp', 'wb') as f:
             pickle.dump(self, f)
+        os.replace(path + '.tmp', path)
+
+    def save(self):
+        """Store the results in a directory, that `open` reads lazily per component (see `resultstore`)."""
+        resultstore.save(self, self.storepath(self.folderpath, self.name))
+
+    @classmethod
+    def open(cls, name, folderpath='') -> resultstore.StoredExperiment:
+        return resultstore.StoredExperiment(cls.storepath(folderpath, name))
+
+    @classmethod
+    def stored(cls, name, folderpath=''):
+        return resultstore.exists(cls.storepath(folderpath, name))
 
     def get(self, key):
         return self.results['key']
     
     @classmethod
-    def unpickle(cls, name) -> Self:
-        with open(cls.path(name), 'rb') as f:
+    def unpickle(cls, name, folderpath='') -> Self:
+        with open(cls.path(folderpath, name), 'rb') as f:
             return pickle.load(f)
         
     @classmethod
     def path(cls, folderpath, name):
         return folderpath + f'{name}'
-    
-    
-    
\ No newline at end of file
+
+    @classmethod
+    def storepath(cls, folderpath, name):
+        return folderpath + f'{name}.results'
+
+
+# Process pool helpers, the input arrays are placed in shared memory once and attached by the workers
+_attached = {}
+
+def _share(data : m.DetectorInput):
+    """Copy the arrays of `data` into shared memory blocks, returns the blocks and a picklable description."""
+    blocks, arrays = [], {}
+    for name in ('seqid', 'timeindex_bin', 'timeindex', 'features'):
+        array = getattr(data, name)
+        if array.dtype.hasobject:
+            arrays[name] = array
+            continue
+
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        blocks += [block]
+        arrays[name] = (block.name, array.shape, array.dtype.str)
+
+    return blocks, (arrays, data.seqids, data.columns)
+
+def _attach(shared) -> m.DetectorInput:
+    arrays, seqids, columns = shared
+
+    views = {}
+    for name, array in arrays.items():
+        if isinstance(array, np.ndarray):
+            views[name] = array
+            continue
+
+        block_name, shape, dtype = array
+        if block_name not in _attached:
+            _attached[block_name] = shared_memory.SharedMemory(name=block_name)
+        views[name] = np.ndarray(shape, dtype, buffer=_attached[block_name].buf)
+
+    return m.DetectorInput(views['seqid'], seqids, views['timeindex_bin'], views['timeindex'], views['features'], columns)
+
+def _fit_score_unit(model, columns, shared, start, stop, cache=None, group=0, memory=False, share=None):
+    """
+    Scores of `model` on a group with every stage limited to `share` cores, with the (cores, wall, wait) of
+    `StageAllotment.timing`, the CPU time of the worker process (its threads and child processes) and the steps
+    recorded in the worker.
+    """
+    data = _attach(shared).slice(start, stop)
+    recorder = Recorder(memory, cpu=cpu_time)
+    step = StageAllotment(CoreScheduler(share), model, recorder.stepper(model.name, group, len(data)))
+
+    with recorder.tracing():
+        start, cpu = time.perf_counter(), cpu_time()
+        scores = cache.fit_score(model, data, columns, step) if cache else model.fit_score(data, columns, step=step)
+        wall, cpu = time.perf_counter() - start, cpu_time() - cpu
+
+    wall, wait, cores = step.timing(wall)
+    return scores, (cores, wall, wait), cpu, recorder.records
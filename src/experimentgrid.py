@@ -0,0 +1,213 @@
+# Python file with a grid runner over synthetic noise experiments, with cached datasets and resumable checkpoints.
+
+#region Imports
+import os
+import pickle
+import itertools
+import numpy as np
+import pandas as pd
+import concurrent.futures
+
+from dataclasses import dataclass
+
+import aggregators as agg
+from experiment import Experiment
+from noise import NoiseFactory
+#endregion
+
+#region Cells
+@dataclass(frozen=True)
+class Dataset:
+    """One synthetic dataset of the grid, shared by all model sets."""
+    noise : str
+    intensity : float
+    ratio : float
+    robotids : tuple[str, ...]
+
+    @property
+    def name(self):
+        name = f"{self.noise}_{self.ratio}_{self.intensity}"
+        if self.robotids:
+            name = name + f"_{'_'.join(item.strip() for item in self.robotids)}"
+        return name
+
+@dataclass(frozen=True)
+class Cell:
+    """One experiment of the grid, a model set run on a dataset."""
+    dataset : Dataset
+    models : str
+
+    @property
+    def name(self):
+        return f"{self.dataset.name}_{self.models}"
+#endregion
+
+#region ExperimentGrid
+class ExperimentGrid:
+    """
+    Runs an `Experiment` for every cell of a sweep over noise type x intensity x ratio x robots x model set.
+
+    Every synthetic dataset is generated once with `NoiseFactory` and cached in `path/datasets`, all model sets
+    run on the same cached dataset. Every finished cell is stored to `path/experiments` as its checkpoint (see
+    `resultstore`), a rerun of the grid opens the finished cells and only runs the remaining ones.
+
+    With a `fraction`, `run` previews the cells on a stratified sample of the sequences (see `Experiment.preview`),
+    stored apart from the full runs in `path/previews`. The promising cells can then be run in full by name.
+
+    :param path: str, folder of the dataset cache and the checkpoints
+    :param noise: dict, intensities per noise type, e.g. {'gaussian': [0.1, 0.25], 'point': [1, 5]}
+    :param ratios: list of float, ratios of sequences that get a synthetic anomaly
+    :param robotids: list of lists of robot ids, every list is one subset of the data (an empty list is all data)
+    :param models: dict, list of detectors per model set name
+    :param columns: list of str, feature columns of the detectors
+    :param syn_column: str, column the noise is added to
+    :param aggrfunc: function, aggregation of the scores per sequence, see `aggregators`
+    :param spliton: str, column to split the experiments on, see `Experiment.run`
+    :param seed: int, seed of the noise, every dataset gets its own stream derived from it and its name
+    """
+    def __init__(self, path, noise, ratios, robotids, models, columns, syn_column, aggrfunc=agg.aggr_sum, spliton="robotid", seed=42):
+        self.path = os.path.join(path, '')
+        self.noise = noise
+        self.ratios = ratios
+        self.robotids = [tuple(ids) for ids in robotids]
+        self.models = models
+        self.columns = columns
+        self.syn_column = syn_column
+        self.aggrfunc = aggrfunc
+        self.spliton = spliton
+        self.seed = seed
+
+    def datasets(self):
+        return [
+            Dataset(noise, intensity, ratio, ids)
+            for noise, intensities in self.noise.items()
+            for intensity, ratio, ids in itertools.product(intensities, self.ratios, self.robotids)
+        ]
+
+    def cells(self):
+        return [Cell(dataset, models) for dataset in self.datasets() for models in self.models]
+
+    def dataset_path(self, dataset):
+        return os.path.join(self.path, 'datasets', f"{dataset.name}.pkl")
+
+    def experiment_path(self, preview=False):
+        return os.path.join(self.path, 'previews' if preview else 'experiments', '')
+
+    def finished(self, cell, preview=False):
+        return Experiment.stored(cell.name, self.experiment_path(preview))
+
+    def run(self, df, max_workers=None, verbose=False, fraction=None, cells=None):
+        """
+        Run all unfinished cells on `df`, `max_workers` cells side by side in a process pool (default all cores).
+        With a `fraction` the cells are previewed on that fraction of the sequences, with `cells` only the cells of
+        these names run. Returns the experiments of all cells (or previews), by cell name.
+        """
+        max_workers = max_workers or os.cpu_count()
+        preview = fraction is not None
+        todo = [cell for cell in self.cells() if not self.finished(cell, preview) and (cells is None or cell.name in cells)]
+
+        # Generate the missing datasets first, such that cells never generate the same dataset twice
+        datasets = [dataset for dataset in self.datasets() if not os.path.exists(self.dataset_path(dataset))]
+        datasets = [dataset for dataset in datasets if any(cell.dataset == dataset for cell in todo)]
+        self._map(self._generate, [(df, dataset) for dataset in datasets], max_workers, verbose, "Generated")
+
+        # Every cell runs its models on its share of the cores
+        cores = max(1, os.cpu_count() // min(max_workers, max(len(todo), 1)))
+        self._map(self._run_cell, [(cell, cores, fraction) for cell in todo], max_workers, verbose, "Finished")
+
+        return self.load(preview)
+
+    def load(self, preview=False):
+        """The stored experiments of all finished cells by cell name, their components are read on first use."""
+        return {
+            cell.name : Experiment.open(cell.name, self.experiment_path(preview))
+            for cell in self.cells() if self.finished(cell, preview)
+        }
+
+    def results(self, preview=False):
+        """
+        AUC-PR and AUC-ROC of every model of every finished cell, one row per (cell, model). The previews also
+        have the bounds of the bootstrap intervals of the AUCs.
+        """
+        experiments = self.load(preview)
+
+        rows = []
+        for cell in self.cells():
+            if cell.name not in experiments:
+                continue
+            results = experiments[cell.name].meta
+            rows += [{
+                'noise' : cell.dataset.noise,
+                'intensity' : cell.dataset.intensity,
+                'ratio' : cell.dataset.ratio,
+                'robotids' : '_'.join(cell.dataset.robotids),
+                'models' : cell.models,
+                'model' : name,
+                'auc-pr' : results['auc-pr'][name],
+                'auc-roc' : results['auc-roc'][name],
+            } for name in results['auc-pr']]
+
+            if preview:
+                intervals = experiments[cell.name].table('auc-ci').set_index(['model', 'metric'])
+                for row in rows[-len(results['auc-pr']):]:
+                    for metric in ('auc-pr', 'auc-roc'):
+                        row[f"{metric}-lower"], row[f"{metric}-upper"] = intervals.loc[(row['model'], metric), ['lower', 'upper']]
+
+        return pd.DataFrame(rows)
+
+    def _map(self, func, args, max_workers, verbose, message):
+        if max_workers == 1 or len(args) <= 1:
+            for arg in args:
+                name = func(*arg)
+                if verbose:
+                    print(f"{message} {name}")
+            return
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(max_workers, len(args))) as executor:
+            futures = [executor.submit(func, *arg) for arg in args]
+            for future in concurrent.futures.as_completed(futures):
+                name = future.result()
+                if verbose:
+                    print(f"{message} {name}")
+
+    def _generate(self, df, dataset):
+        if dataset.robotids:
+            df = df[df['robotid'].isin(dataset.robotids)]
+
+        # NoiseFactory draws from the global numpy state. Seed it from the dataset name, such that a dataset gets the
+        # same noise whatever the other datasets of the grid are.
+        np.random.seed(np.random.SeedSequence([self.seed, *dataset.name.encode()]).generate_state(1)[0])
+
+        generate = getattr(NoiseFactory, dataset.noise)
+        df_syn = generate(df, self.syn_column, dataset.ratio, dataset.intensity)
+        df_syn['anomalous'] = df_syn['anomaly_syn_type'] != ""
+
+        _dump(df_syn, self.dataset_path(dataset))
+        return dataset.name
+
+    def _run_cell(self, cell, cores, fraction=None):
+        with open(self.dataset_path(cell.dataset), 'rb') as f:
+            df = pickle.load(f)
+        df_anomalies = df.groupby('seqid').agg({'anomalous' : 'any'})
+
+        experiment = Experiment(cell.name, self.experiment_path(fraction is not None))
+        experiment.set_anomalies(df_anomalies)
+
+        columns = (['seqid', 'timeindex_bin'], self.columns)
+        if fraction is None:
+            experiment.run(df, self.models[cell.models], columns, spliton=self.spliton, max_workers=cores)
+            experiment.calculate_metrics(aggrfunc=self.aggrfunc)
+        else:
+            experiment.preview(df, self.models[cell.models], columns, self.aggrfunc, fraction, seed=self.seed, spliton=self.spliton, max_workers=cores)
+
+        # The checkpoint, written last such that an interrupted cell is rerun
+        experiment.save()
+        return cell.name
+
+def _dump(obj, path):
+    """Pickle `obj` to `path` through a temporary file, such that an interrupted write never leaves a partial file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(obj, f)
+    os.replace(path + '.tmp', path)
+#endregion
@@ -0,0 +1,153 @@
+# Python file with thread-safe recording of the wall time, CPU time and memory of the steps of an experiment.
+
+#region Imports
+import os
+import json
+import time
+import threading
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+#endregion
+
+#region Clocks
+def _children_time():
+    """CPU time of the child processes waited for (e.g. those of a process pool that was shut down)."""
+    if resource is None:
+        return 0.0
+
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return children.ru_utime + children.ru_stime
+
+def cpu_time():
+    """
+    CPU time of the process, of all its threads and of its waited-for child processes, for a worker process that
+    runs one unit at a time. Without the resource module (on Windows) the child processes do not count.
+    """
+    return time.process_time() + _children_time()
+
+def thread_cpu_time():
+    """
+    CPU time of the calling thread and of the waited-for child processes of the process, for units that run in
+    threads side by side. The threads a unit starts itself do not count, the process pools it starts do.
+    """
+    return time.thread_time() + _children_time()
+#endregion
+
+#region Recorder
+class Recorder:
+    """
+    Records the wall time, CPU time, rows/sec and peak memory of every (model, group, stage) step, from any number
+    of threads. The steps of worker processes are recorded by a recorder in the worker and added with `extend`.
+
+    The CPU time is by default that of the thread running the step, plus the process pools it started (see
+    `thread_cpu_time`), such that steps of models in threads side by side only count their own CPU time. A worker
+    process that runs one unit at a time records with the clock of the whole process, `cpu_time`.
+
+    The peak memory is that of tracemalloc (Python and numpy allocations), relative to the traced memory at the
+    start of the step. Tracemalloc has one peak per process, which is only reset when no other step is running,
+    so the peak of steps that overlap in time is the peak of all of them together (an upper bound).
+
+    :param memory: bool, whether to trace the memory, which slows down the detectors several times
+    :param cpu: function, CPU clock of a step, `thread_cpu_time` or `cpu_time`
+    """
+    COLUMNS = ['model', 'group', 'stage', 'rows', 'start', 'wall', 'cpu', 'rows/s', 'peak', 'pid', 'thread']
+
+    def __init__(self, memory=False, cpu=thread_cpu_time):
+        self.memory = memory
+        self.cpu = cpu
+        self.records = []
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+        self.active = 0
+
+    @contextmanager
+    def tracing(self):
+        """Trace the memory while in the context, if enabled and not traced already."""
+        started = self.memory and not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        try:
+            yield self
+        finally:
+            if started:
+                tracemalloc.stop()
+
+    @contextmanager
+    def step(self, model, group, stage, rows):
+        traced = self.memory and tracemalloc.is_tracing()
+        with self.lock:
+            if traced and self.active == 0:
+                tracemalloc.reset_peak()
+            self.active += 1
+            current = tracemalloc.get_traced_memory()[0] if traced else 0
+
+        start, cpu = time.perf_counter(), self.cpu()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - start, self.cpu() - cpu
+
+            with self.lock:
+                self.active -= 1
+                peak = tracemalloc.get_traced_memory()[1] - current if traced else np.nan
+                self.records += [(model, group, stage, rows, start, wall, cpu, rows / wall if wall > 0 else np.nan,
+                                  peak, os.getpid(), threading.get_ident())]
+
+    def stepper(self, model, group, rows):
+        """The `step` of a (model, group) as a function of the stage only, as `AnomalyDetector.fit_score` takes it."""
+        return lambda stage : self.step(model, group, stage, rows)
+
+    def extend(self, records):
+        with self.lock:
+            self.records += records
+
+    def frame(self):
+        """
+        The steps as a DataFrame, with the start in seconds since the creation of the recorder, whose
+        `time.perf_counter` is kept in frame.attrs['origin'] to line up the steps of several recorders.
+        """
+        with self.lock:
+            frame = pd.DataFrame(self.records, columns=self.COLUMNS)
+        frame['start'] -= self.origin
+        frame.attrs['origin'] = self.origin
+        return frame
+#endregion
+
+#region Trace
+def export_trace(steps, path):
+    """
+    Write the steps of `Recorder.frame` as a Chrome trace (JSON), to view in chrome://tracing or Perfetto. Every
+    model is a row of the trace, every step a slice named after its stage and group.
+    """
+    models = {model : i for i, model in enumerate(dict.fromkeys(steps['model']))}
+
+    events = [{
+        'name' : f"{step['stage']} {step['group']}",
+        'cat' : step['stage'],
+        'ph' : 'X',
+        'ts' : step['start'] * 1e6,
+        'dur' : step['wall'] * 1e6,
+        'pid' : int(step['pid']),
+        'tid' : models[step['model']],
+        'args' : {'rows' : int(step['rows']), 'cpu' : step['cpu'], 'rows/s' : _json(step['rows/s']), 'peak' : _json(step['peak'])},
+    } for step in steps.to_dict('records')]
+
+    events += [
+        {'name' : 'thread_name', 'ph' : 'M', 'pid' : int(pid), 'tid' : tid, 'args' : {'name' : model}}
+        for pid in steps['pid'].unique() for model, tid in models.items()
+    ]
+
+    with open(path, 'w') as f:
+        json.dump({'traceEvents' : events, 'displayTimeUnit' : 'ms'}, f)
+
+def _json(value):
+    return None if np.isnan(value) else float(value)
+#endregion
@@ -0,0 +1,214 @@
+# Python file with the PR and ROC curves of many score columns from a single sort per column.
+
+#region Imports
+import os
+import warnings
+import itertools
+import numpy as np
+import pandas as pd
+import concurrent.futures
+#endregion
+
+#region Counts
+def threshold_counts(y_true, scores):
+    """
+    Cumulative true and false positive counts at every distinct threshold of every score column, as
+    `sklearn.metrics._ranking._binary_clf_curve`. Every column is sorted once, all columns in one call.
+
+    :param y_true: array-like of bool, per sequence whether it is anomalous
+    :param scores: array-like (n_samples x n_columns), scores per sequence, higher is more anomalous
+    :return: list with (tps, fps, thresholds) per column
+    """
+    y_true = np.asarray(y_true, dtype=bool)
+    scores = np.asarray(scores, dtype=np.float64).reshape(len(y_true), -1)
+
+    order = np.argsort(scores, axis=0, kind='mergesort')[::-1]
+    sorted_scores = np.take_along_axis(scores, order, axis=0)
+    cumulative = np.cumsum(y_true[order], axis=0)
+
+    counts = []
+    for i in range(scores.shape[1]):
+        # The last position of every run of equal scores is a threshold
+        ends = np.r_[np.flatnonzero(np.diff(sorted_scores[:, i])), len(y_true) - 1]
+        tps = cumulative[ends, i]
+        counts += [(tps, ends + 1 - tps, sorted_scores[ends, i])]
+
+    return counts
+#endregion
+
+#region Curves
+def pr_curve(tps, fps, thresholds):
+    """Precision, recall and thresholds from the counts, as `sklearn.metrics.precision_recall_curve`."""
+    positives = tps + fps
+    precision = np.divide(tps, positives, out=np.zeros(len(tps)), where=positives != 0)
+
+    if tps[-1] == 0:
+        warnings.warn("No positive class found in y_true, recall is set to one for all thresholds", UserWarning)
+        recall = np.ones(len(tps))
+    else:
+        recall = tps / tps[-1]
+
+    return np.hstack((precision[::-1], 1)), np.hstack((recall[::-1], 0)), thresholds[::-1]
+
+def roc_curve(tps, fps, thresholds):
+    """False and true positive rates and thresholds from the counts, as `sklearn.metrics.roc_curve`."""
+    # Drop the thresholds that are collinear with their neighbours (drop_intermediate)
+    if len(fps) > 2:
+        keep = np.flatnonzero(np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True])
+        tps, fps, thresholds = tps[keep], fps[keep], thresholds[keep]
+
+    tps, fps, thresholds = np.r_[0, tps], np.r_[0, fps], np.r_[np.inf, thresholds]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fpr, tpr = fps / fps[-1], tps / tps[-1]
+
+    return fpr, tpr, thresholds
+
+def area(x, y):
+    """Area under the monotonic curve (x, y), as `sklearn.metrics.auc`."""
+    return abs(np.trapezoid(y, x))
+#endregion
+
+#region Downsampling
+def downsample(curve, max_thresholds, closed=False):
+    """
+    The curve at no more than `max_thresholds` evenly spread thresholds, always including the first and last.
+
+    :param curve: tuple (x, y, thresholds)
+    :param closed: bool, whether x and y have one more point than thresholds (the PR curve's end point)
+    """
+    x, y, thresholds = curve
+    if max_thresholds is None or len(thresholds) <= max_thresholds:
+        return curve
+
+    keep = np.unique(np.linspace(0, len(thresholds) - 1, max_thresholds).round().astype(int))
+    if closed:
+        return np.r_[x[keep], x[-1]], np.r_[y[keep], y[-1]], thresholds[keep]
+    return x[keep], y[keep], thresholds[keep]
+#endregion
+
+#region Metrics
+def evaluate(y_true, scores, columns, max_thresholds=None):
+    """
+    PR and ROC curves and their AUCs of every score column, derived from the same cumulative counts.
+
+    The AUCs are computed on the full curves, `max_thresholds` only limits the size of the returned curves.
+
+    :param y_true: array-like of bool, per sequence whether it is anomalous
+    :param scores: array-like (n_samples x n_columns), scores per sequence
+    :param columns: list of str, names of the score columns
+    :param max_thresholds: int, maximum number of thresholds per returned curve (None keeps all)
+    :return: dict with per column dicts 'pr', 'roc', 'auc-pr' and 'auc-roc'
+    """
+    results = {'pr' : {}, 'roc' : {}, 'auc-pr' : {}, 'auc-roc' : {}}
+
+    for name, counts in zip(columns, threshold_counts(y_true, scores)):
+        pr, roc = pr_curve(*counts), roc_curve(*counts)
+
+        results['auc-pr'][name] = area(pr[1], pr[0])
+        results['auc-roc'][name] = area(roc[0], roc[1])
+        results['pr'][name] = downsample(pr, max_thresholds, closed=True)
+        results['roc'][name] = downsample(roc, max_thresholds)
+
+    return results
+#endregion
+
+#region Bootstrap
+def resampled_auc(y_true, scores, samples):
+    """
+    AUC-PR and AUC-ROC of every score column on every resample, all resamples of a column in one sort.
+
+    Within a run of tied scores every position takes the counts at the end of the run, such that the ties add
+    no area, as a curve over the distinct thresholds. Resamples without positives (or negatives) give NaN.
+
+    :param y_true: array of bool (n_samples)
+    :param scores: array (n_samples x n_columns)
+    :param samples: array of int (n_resamples x n_samples), indices of every resample
+    :return: arrays of AUC-PR and AUC-ROC (n_resamples x n_columns)
+    """
+    labels = y_true[samples]
+    positions = np.arange(samples.shape[1])
+    auc_pr, auc_roc = np.empty((len(samples), scores.shape[1])), np.empty((len(samples), scores.shape[1]))
+
+    for i in range(scores.shape[1]):
+        values = scores[samples, i]
+        order = np.argsort(values, axis=1, kind='mergesort')[:, ::-1]
+        values = np.take_along_axis(values, order, axis=1)
+        tps = np.cumsum(np.take_along_axis(labels, order, axis=1), axis=1)
+
+        # Every position takes the counts at the end of its run of ties, the run ends filled back with a reverse minimum
+        ends = np.where(np.c_[values[:, 1:] != values[:, :-1], np.ones(len(values), dtype=bool)], positions, positions[-1])
+        ends = np.minimum.accumulate(ends[:, ::-1], axis=1)[:, ::-1]
+        tps = np.take_along_axis(tps, ends, axis=1)
+        fps = ends + 1 - tps
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = tps / (ends + 1)
+            recall = tps / tps[:, -1:]
+            fpr = fps / fps[:, -1:]
+
+        # The curves start at recall 0 with precision 1, and at the origin of the ROC space
+        recall, precision = np.c_[np.zeros(len(values)), recall], np.c_[np.ones(len(values)), precision]
+        fpr, tpr = np.c_[np.zeros(len(values)), fpr], np.c_[np.zeros(len(values)), recall[:, 1:]]
+
+        auc_pr[:, i] = np.sum(np.diff(recall, axis=1) * (precision[:, 1:] + precision[:, :-1]) / 2, axis=1)
+        auc_roc[:, i] = np.sum(np.diff(fpr, axis=1) * (tpr[:, 1:] + tpr[:, :-1]) / 2, axis=1)
+
+    return auc_pr, auc_roc
+
+def _bootstrap_chunk(y_true, scores, n_replicates, seed):
+    rng = np.random.default_rng(seed)
+    return resampled_auc(y_true, scores, rng.integers(0, len(y_true), (n_replicates, len(y_true))))
+
+def bootstrap(y_true, scores, columns, n_replicates=1000, alpha=0.05, seed=42, n_jobs=None, chunksize=100):
+    """
+    Bootstrap confidence intervals of the AUC-PR and AUC-ROC of every score column, and of the paired differences
+    between every two columns. All columns are evaluated on the same resamples of the sequences, such that the
+    differences are paired. The resamples are drawn as index matrices of `chunksize` replicates, every chunk
+    from its own seed spawned from `seed`, spread over `n_jobs` worker processes (default all cores).
+
+    :param y_true: array-like of bool, per sequence whether it is anomalous
+    :param scores: array-like (n_samples x n_columns), scores per sequence
+    :param columns: list of str, names of the score columns
+    :param alpha: float, the intervals are the alpha/2 and 1 - alpha/2 percentiles
+    :return: DataFrame of the intervals per (column, metric), DataFrame of the paired differences per
+        (column, other, metric) with the fraction of replicates in which column does not beat other ('p')
+    """
+    y_true = np.asarray(y_true, dtype=bool)
+    scores = np.asarray(scores, dtype=np.float64).reshape(len(y_true), -1)
+
+    sizes = [min(chunksize, n_replicates - start) for start in range(0, n_replicates, chunksize)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+
+    n_jobs = min(n_jobs or os.cpu_count(), len(sizes))
+    if n_jobs <= 1:
+        chunks = [_bootstrap_chunk(y_true, scores, size, seed) for size, seed in zip(sizes, seeds)]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            chunks = list(executor.map(_bootstrap_chunk, itertools.repeat(y_true), itertools.repeat(scores), sizes, seeds))
+
+    point = resampled_auc(y_true, scores, np.arange(len(y_true))[None, :])
+    replicates = {
+        'auc-pr' : (point[0][0], np.concatenate([chunk[0] for chunk in chunks])),
+        'auc-roc' : (point[1][0], np.concatenate([chunk[1] for chunk in chunks])),
+    }
+
+    intervals, differences = [], []
+    for metric, (estimate, values) in replicates.items():
+        lower, upper = np.nanpercentile(values, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+        intervals += [
+            {'model' : name, 'metric' : metric, 'auc' : estimate[i], 'lower' : lower[i], 'upper' : upper[i]}
+            for i, name in enumerate(columns)
+        ]
+
+        for i, j in itertools.combinations(range(len(columns)), 2):
+            difference = values[:, i] - values[:, j]
+            lower, upper = np.nanpercentile(difference, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+            differences += [{
+                'model' : columns[i], 'other' : columns[j], 'metric' : metric,
+                'difference' : estimate[i] - estimate[j], 'lower' : lower, 'upper' : upper,
+                'p' : np.mean(difference[~np.isnan(difference)] <= 0),
+            }]
+
+    return pd.DataFrame(intervals), pd.DataFrame(differences)
+#endregion
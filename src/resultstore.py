@@ -0,0 +1,144 @@
+# Python file with a directory based store of experiment results, loaded lazily per component.
+
+#region Imports
+import os
+import json
+import numpy as np
+import pandas as pd
+
+from collections.abc import Mapping
+#endregion
+
+#region Layout
+# Tables are stored as Parquet, readable per column. The curves are stored in one npz, read per array.
+# meta.json is written last and marks the experiment as complete.
+TABLES = ('input', 'df', 'df_agg', 'timings', 'steps', 'auc-ci', 'auc-diff', 'anomalies')
+CURVES = ('pr', 'roc')
+AUCS = ('auc-pr', 'auc-roc')
+META = 'meta.json'
+#endregion
+
+#region Save
+def save(experiment, path):
+    """
+    Store the results of `experiment` in the directory `path`.
+
+    :param experiment: Experiment
+    :param path: str, directory of the experiment, created if needed
+    """
+    os.makedirs(path, exist_ok=True)
+
+    # An existing meta.json first goes, such that a store interrupted while overwriting is incomplete
+    if os.path.exists(os.path.join(path, META)):
+        os.remove(os.path.join(path, META))
+
+    tables = dict(experiment.results, anomalies=experiment.anomalies)
+    for name in TABLES:
+        table = tables.get(name)
+        if isinstance(table, pd.DataFrame) and not table.empty:
+            table.to_parquet(os.path.join(path, f"{name}.parquet"))
+
+    curves = {
+        f"{curve}/{model}/{i}" : np.asarray(array)
+        for curve in CURVES for model, arrays in experiment.results[curve].items() for i, array in enumerate(arrays)
+    }
+    np.savez(os.path.join(path, 'curves.npz'), **curves)
+
+    meta = {
+        'name' : experiment.name,
+        'model_names' : list(experiment.model_names),
+        'tables' : [name for name in TABLES if os.path.exists(os.path.join(path, f"{name}.parquet"))],
+    }
+    meta.update({name : {model : float(value) for model, value in experiment.results[name].items()} for name in AUCS})
+
+    with open(os.path.join(path, META + '.tmp'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(os.path.join(path, META + '.tmp'), os.path.join(path, META))
+
+def exists(path):
+    return os.path.exists(os.path.join(path, META))
+#endregion
+
+#region StoredExperiment
+class StoredExperiment:
+    """
+    Read-only view of a stored experiment, every component is read from disk on first use.
+
+    `results` has the keys of `Experiment.results`, such that the plotting code works on either. The tables can
+    also be read with a column projection through `table`, the curves per model through `curve`.
+
+    :param path: str, directory of the experiment, see `save`
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META)) as f:
+            self.meta = json.load(f)
+
+        self.name = self.meta['name']
+        self.model_names = self.meta['model_names']
+        self.results = _LazyResults(self)
+        self._curves = None
+
+    @property
+    def anomalies(self):
+        return self.table('anomalies')
+
+    def table(self, name, columns=None):
+        """The table `name` (e.g. 'df' or 'df_agg'), only the given `columns` (and the index) are read."""
+        if name not in self.meta['tables']:
+            return pd.DataFrame()
+        return pd.read_parquet(os.path.join(self.path, f"{name}.parquet"), columns=columns)
+
+    def curve(self, curve, model):
+        """The arrays of the curve `curve` ('pr' or 'roc') of `model`, as returned by sklearn."""
+        if self._curves is None:
+            self._curves = np.load(os.path.join(self.path, 'curves.npz'))
+
+        arrays, i = [], 0
+        while f"{curve}/{model}/{i}" in self._curves.files:
+            arrays += [self._curves[f"{curve}/{model}/{i}"]]
+            i += 1
+
+        if not arrays:
+            raise KeyError(model)
+        return tuple(arrays)
+
+class _LazyResults(Mapping):
+    """`Experiment.results` of a stored experiment, the components are read on first access and kept."""
+    def __init__(self, experiment):
+        self.experiment = experiment
+        self.loaded = {}
+
+    def __getitem__(self, key):
+        if key not in self.loaded:
+            if key in TABLES:
+                self.loaded[key] = self.experiment.table(key)
+            elif key in CURVES:
+                self.loaded[key] = _LazyCurves(self.experiment, key)
+            elif key in AUCS:
+                self.loaded[key] = self.experiment.meta[key]
+            else:
+                raise KeyError(key)
+        return self.loaded[key]
+
+    def __iter__(self):
+        return iter(TABLES[:-1] + CURVES + AUCS)
+
+    def __len__(self):
+        return len(TABLES) - 1 + len(CURVES) + len(AUCS)
+
+class _LazyCurves(Mapping):
+    """The curves of one kind per model, every model is read on first access."""
+    def __init__(self, experiment, curve):
+        self.experiment = experiment
+        self.curve = curve
+
+    def __getitem__(self, model):
+        return self.experiment.curve(self.curve, model)
+
+    def __iter__(self):
+        return iter(self.experiment.meta[f"auc-{self.curve}"])
+
+    def __len__(self):
+        return len(self.experiment.meta[f"auc-{self.curve}"])
+#endregion
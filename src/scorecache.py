@@ -0,0 +1,128 @@
+# Python file with a content-addressed disk cache of detector scores, shared across experiments.
+
+#region Imports
+import os
+import types
+import joblib
+import pickle
+import warnings
+import numpy as np
+
+from contextlib import nullcontext
+#endregion
+
+#region ScoreCache
+class ScoreCache:
+    """
+    Disk cache of the scores of `AnomalyDetector.fit_score`, keyed by a hash of the input data, the columns and
+    the detector's class and hyperparameters (see `AnomalyDetector.params`). Rerunning an experiment of which
+    only the evaluation changed then reads the scores instead of refitting the detectors.
+
+    Every entry is one .npy file. Reading an entry updates its modification time, and after every write the
+    least recently used entries are removed until the cache is at most `max_bytes`. The cache only holds its
+    path, such that it can be passed to worker processes, which may read and write it concurrently.
+
+    :param path: str, folder of the cache
+    :param max_bytes: int, size cap of the cache (default 1 GiB)
+    """
+    def __init__(self, path, max_bytes=2**30):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(model, data, columns):
+        """Hash of the detector and its input, `data` is a DetectorInput."""
+        # Only the sequence ids of the rows count, not those of the other groups the input is a slice of
+        used, seqid = np.unique(data.seqid, return_inverse=True)
+
+        return joblib.hash((
+            type(model).__module__, type(model).__qualname__, _hashable(model.params()), [list(c) for c in columns],
+            data.seqids[used], seqid, data.timeindex_bin, data.timeindex, data.features, data.columns,
+        ))
+
+    def file(self, key):
+        return os.path.join(self.path, f"{key}.npy")
+
+    def get(self, key):
+        """The cached scores of `key`, or None."""
+        try:
+            scores = np.load(self.file(key))
+            os.utime(self.file(key))
+        except (FileNotFoundError, ValueError, EOFError):
+            return None
+        return scores
+
+    def put(self, key, scores):
+        os.makedirs(self.path, exist_ok=True)
+
+        # Written through a temporary file, such that concurrent readers never see a partial entry
+        tmp = self.file(key) + f".{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            np.save(f, np.asarray(scores))
+        os.replace(tmp, self.file(key))
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is at most `max_bytes`."""
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries += [(stat.st_mtime, stat.st_size, entry.path)]
+
+        size = sum(size for _, size, _ in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+
+    def fit_score(self, model, data, columns, step=None):
+        """
+        `model.fit_score`, or the cached scores of the same detector on the same input (leaving `model` unfitted).
+        A cache lookup runs in the stage 'cache' of `step`, see `AnomalyDetector.fit_score`.
+        """
+        step = step or (lambda stage : nullcontext())
+
+        with step('cache'):
+            try:
+                key = self.key(model, data, columns)
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                warnings.warn(f"{model.name} is not cached, its parameters cannot be hashed: {e}", UserWarning)
+                key = None
+            scores = None if key is None else self.get(key)
+
+        if scores is None:
+            scores = model.fit_score(data, columns, step=step)
+            if key is not None:
+                self.put(key, scores)
+
+        return scores
+
+def _hashable(value):
+    """
+    `value` with the Python functions in it (e.g. a lambda as aggr) replaced by their module, qualified name, code
+    and the values they close over, which pickle unlike the lambdas themselves. A changed function body changes
+    the hash.
+    """
+    if isinstance(value, dict):
+        return {key : _hashable(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(_hashable(item) for item in value)
+    if isinstance(value, types.FunctionType):
+        closure = tuple(_hashable(cell.cell_contents) for cell in value.__closure__ or ())
+        return (value.__module__, value.__qualname__, _code(value.__code__), _hashable(value.__defaults__), closure)
+    return value
+
+def _code(code):
+    """Bytecode, constants (with nested code) and referenced names of a code object."""
+    consts = tuple(_code(const) if isinstance(const, types.CodeType) else const for const in code.co_consts)
+    return (code.co_code, consts, code.co_names)
+#endregion
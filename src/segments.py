@@ -0,0 +1,138 @@
+# Python file with a sorted segment layout, used to compute grouped statistics without pandas groupby/merge.
+
+#region Imports
+import numpy as np
+import pandas as pd
+#endregion
+
+#region SegmentIndex
+class SegmentIndex:
+    """
+    Sorted layout of rows grouped by a key (e.g. 'timeindex_bin' or 'seqid').
+
+    The rows are sorted once by key (and optionally by secondary columns within a key), after which
+    every grouped reduction is a single `reduceat` over contiguous segments and every per-group value
+    is gathered back onto the rows with integer indexing.
+
+    :param keys: array-like, group key per row
+    :param sortby: array-likes, secondary sort keys within a group (e.g. 'timeindex_bin' within 'seqid')
+    """
+    def __init__(self, keys, *sortby):
+        self.codes, self.labels = pd.factorize(np.asarray(keys), sort=True)
+        self.order = np.lexsort(tuple(np.asarray(s) for s in reversed(sortby)) + (self.codes,))
+        self.presorted = bool(np.all(self.order[1:] > self.order[:-1]))
+        self.counts = np.bincount(self.codes, minlength=len(self.labels))
+        self.ends = np.cumsum(self.counts)
+        self.starts = self.ends - self.counts
+
+    def __len__(self):
+        return len(self.labels)
+
+    def sort(self, values):
+        """Rows of `values` (in original row order) in segment order, without a copy if the rows already are."""
+        return np.asarray(values) if self.presorted else np.asarray(values)[self.order]
+
+    def gather(self, segvalues):
+        """Per-segment values spread back onto the rows, in original row order."""
+        return np.asarray(segvalues)[self.codes]
+
+    def reduce(self, values, ufunc=np.add, presorted=False):
+        """Reduce `values` per segment with `ufunc`, along the first axis."""
+        values = np.asarray(values) if presorted else self.sort(values)
+        if len(values) == 0:
+            return np.zeros((0,) + values.shape[1:], dtype=values.dtype)
+        return ufunc.reduceat(values, self.starts, axis=0)
+
+    def sum(self, values):
+        return self.reduce(values)
+
+    def count(self, values):
+        """Per-segment number of values that are not NaN (per column)."""
+        return self.sum((~np.isnan(np.asarray(values, dtype=np.float64))).astype(np.int64))
+
+    def mean(self, values):
+        """Per-segment mean skipping NaN like pandas, NaN for segments without values."""
+        values = np.asarray(values, dtype=np.float64)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.sum(np.where(np.isnan(values), 0, values)) / self.count(values)
+
+    def m2(self, values):
+        """Per-segment sum of squared deviations from the segment mean, skipping NaN."""
+        values = np.asarray(values, dtype=np.float64)
+        deviations = values - self.gather(self.mean(values))
+        return self.sum(np.where(np.isnan(deviations), 0, deviations**2))
+
+    def std(self, values, ddof=1):
+        """Per-segment standard deviation (two-pass) skipping NaN, NaN for segments with `count <= ddof` like pandas."""
+        counts = self.count(values)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var = self.m2(values) / (counts - ddof)
+        var[counts <= ddof] = np.nan
+
+        return np.sqrt(var)
+
+    def comoment(self, values):
+        """
+        Per-segment sums of the outer products of the deviations from the segment mean (n_segments x n_features x
+        n_features). Rows with a NaN in any feature are left out, see `complete_rows`.
+        """
+        values = complete_rows(values)
+        deviations = self.sort(values - self.gather(self.mean(values)))
+        deviations[np.isnan(deviations)] = 0
+
+        n_features = values.shape[1]
+        comoment = np.empty((len(self), n_features, n_features))
+        for i in range(n_features):
+            for j in range(i, n_features):
+                comoment[:, i, j] = comoment[:, j, i] = self.reduce(deviations[:, i] * deviations[:, j], presorted=True)
+
+        return comoment
+
+    def cov(self, values, ddof=1):
+        """Per-segment covariance matrices (n_segments x n_features x n_features), NaN for segments with `count <= ddof`."""
+        counts = self.count(complete_rows(values))[:, 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = self.comoment(values) / (counts - ddof)[:, None, None]
+        cov[counts <= ddof] = np.nan
+
+        return cov
+
+    def sort_within(self, values):
+        """Values in segment order, additionally sorted ascending within every segment (per column)."""
+        # Sort every column on value, then stable sort on the segment codes to restore the layout. The columns
+        # are laid out contiguously and the codes use the smallest integer type, so numpy can radix sort them.
+        values = np.asarray(values)
+        columns = np.ascontiguousarray(np.atleast_2d(values.T))
+        codes = self.codes.astype(np.min_scalar_type(max(len(self) - 1, 0)))
+
+        byvalue = np.argsort(columns, axis=1)
+        bycode = np.argsort(codes[byvalue], axis=1, kind='stable')
+        result = np.take_along_axis(columns, np.take_along_axis(byvalue, bycode, axis=1), axis=1)
+
+        return result.T if values.ndim > 1 else result[0]
+
+    def median(self, values):
+        """Per-segment median skipping NaN, NaN for segments without values."""
+        values = np.asarray(values, dtype=np.float64)
+        counts = self.count(values).reshape(len(self), -1)
+
+        # NaN sort last within a segment, the median is that of the first `counts` values
+        ordered = self.sort_within(values).reshape(len(values), -1)
+        starts = self.starts[:, None]
+        lower = np.take_along_axis(ordered, np.maximum(starts + (counts - 1) // 2, 0), axis=0)
+        upper = np.take_along_axis(ordered, starts + counts // 2, axis=0)
+
+        median = (lower + upper) / 2
+        median[counts == 0] = np.nan
+        return median.reshape((len(self),) + values.shape[1:])
+
+    def mad(self, values):
+        """Per-segment median absolute deviation around the median skipping NaN, as `scipy.stats.median_abs_deviation` with nan_policy='omit'."""
+        values = np.asarray(values, dtype=np.float64)
+        return self.median(np.abs(values - self.gather(self.median(values))))
+
+def complete_rows(values):
+    """Float64 copy of the rows x columns `values`, with the rows that have a NaN set to NaN entirely."""
+    values = np.asarray(values, dtype=np.float64)
+    return np.where(np.isnan(values).any(axis=1, keepdims=True), np.nan, values)
+#endregion